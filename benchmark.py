@@ -0,0 +1,539 @@
+"""Benchmarks da API e das consultas mais pesadas.
+
+http: lanca N clientes em paralelo (threads, cada uma com a sua ligacao
+HTTP keep-alive) contra um servidor ja em execucao e mede o throughput e a
+latencia de cada cenario para varios numeros de clientes. Com
+--slow_clients, mantem tambem esse numero de ligacoes lentas abertas
+durante as medicoes (enviam um cabecalho a cada --slow_interval segundos,
+sem nunca terminar o pedido), para comparar o servidor 'dev' com o 'asgi'.
+
+artist_query: cria um artista sintetico com muitas musicas, albuns e
+playlists numa transacao que e desfeita no fim, e compara a consulta
+antiga de /artist_info (um unico GROUP BY sobre todos os joins) com a
+atual (uma subconsulta por lista). Usa a ligacao definida em config.txt.
+
+album_import: compara a insercao de um album musica a musica (como o
+/add_album fazia) com a insercao em lote atual (insere_album da API, que
+e carregada sem arrancar o servidor), para albuns de varios tamanhos,
+tambem numa transacao desfeita no fim.
+
+prepared: compara as instrucoes de play_song, make_comment e authentication
+enviadas como texto (analisadas e planeadas a cada execucao) com as mesmas
+preparadas uma vez na ligacao (PREPARE/EXECUTE), numa transacao desfeita
+no fim. Usa a ligacao definida em config.txt.
+
+kdf: mede o custo de um hash de palavra-passe (scrypt ou PBKDF2) com os
+parametros dados, em hashes/s e latencia, para varios numeros de threads
+em paralelo. Serve para escolher PASSWORD_SCRYPT_N / PASSWORD_PBKDF2_ITERATIONS
+e PASSWORD_HASH_WORKERS antes de medir o p99 do login com o cenario login.
+
+Exemplos:
+    python benchmark.py http --username Edu --password amocoimbra --scenario mixed --clients 1,2,4,8,16,32
+    python benchmark.py http --username Edu --password amocoimbra --scenario login --clients 1,8,32,64
+    python benchmark.py http --username Edu --password amocoimbra --scenario search --clients 8,32 --slow_clients 2000
+    python benchmark.py http --username Edu --password amocoimbra --scenario play --clients 16,64
+        (repetir com o servidor em `serve prefork 1`, `serve prefork 2`, `serve prefork 4`, ... para ver a escala)
+    python benchmark.py artist_query --songs 2000 --albums 200 --playlists 200
+    python benchmark.py album_import --tracks 10,100,1000
+    python benchmark.py prepared --repeat 2000
+    python benchmark.py kdf --algorithm scrypt --cost 16384 --threads 1,2,4,8
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import re
+import socket
+import statistics
+import threading
+import time
+import urllib.parse
+
+from consultas import Consultas
+
+
+def pedido(ligacao, metodo, caminho, corpo=None, token=None):
+    cabecalhos = {'Content-Type': 'application/json'}
+    if token is not None:
+        cabecalhos['Authorization'] = f'Bearer {token}'
+    dados = json.dumps(corpo) if corpo is not None else None
+    ligacao.request(metodo, caminho, body=dados, headers=cabecalhos)
+    resposta = ligacao.getresponse()
+    conteudo = resposta.read()
+    if resposta.status != 200:
+        return None
+    return json.loads(conteudo)
+
+
+def login(ligacao, username, password):
+    resposta = pedido(ligacao, 'POST', '/login', {'username': username, 'password': password})
+    if resposta is None or resposta['status'] != 200:
+        raise SystemExit(f'login failed: {resposta}')
+    return resposta['results']
+
+
+def cenarios(args):
+    credenciais = {'username': args.username, 'password': args.password}
+    return {
+        'play': [('PUT', f'/{args.song}', None)],
+        'search': [('GET', f'/search_song/{urllib.parse.quote(args.keyword)}', None)],
+        'report': [('GET', f'/report/{args.year_month}', None)],
+        'artist': [('GET', f'/artist_info/{args.artist}', None)],
+        'login': [('POST', '/login', credenciais)],
+        'mixed': [
+            ('PUT', f'/{args.song}', None),
+            ('PUT', f'/{args.song}', None),
+            ('GET', f'/search_song/{urllib.parse.quote(args.keyword)}', None),
+            ('GET', f'/artist_info/{args.artist}', None),
+            ('GET', f'/report/{args.year_month}', None)
+        ]
+    }
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    indice = min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))
+    return valores[indice]
+
+
+def corre(args, token, passos, clientes):
+    url = urllib.parse.urlparse(args.url)
+    fim = time.monotonic() + args.duration
+    latencias = []
+    erros = [0]
+    lock = threading.Lock()
+
+    def cliente():
+        ligacao = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        locais = []
+        falhas = 0
+        i = 0
+        while time.monotonic() < fim:
+            metodo, caminho, corpo = passos[i % len(passos)]
+            i += 1
+            inicio = time.perf_counter()
+            try:
+                resposta = pedido(ligacao, metodo, caminho, corpo, token)
+            except (OSError, http.client.HTTPException):
+                ligacao.close()
+                ligacao = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+                resposta = None
+            locais.append(time.perf_counter() - inicio)
+            if resposta is None or resposta.get('status') != 200:
+                falhas += 1
+        ligacao.close()
+        with lock:
+            latencias.extend(locais)
+            erros[0] += falhas
+
+    threads = [threading.Thread(target=cliente) for i in range(clientes)]
+    inicio = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    decorrido = time.monotonic() - inicio
+
+    latencias.sort()
+    return {
+        'clients': clientes,
+        'requests': len(latencias),
+        'errors': erros[0],
+        'throughput': len(latencias) / decorrido,
+        'p50': percentil(latencias, 50) * 1000,
+        'p95': percentil(latencias, 95) * 1000,
+        'p99': percentil(latencias, 99) * 1000
+    }
+
+
+def clientes_lentos(url, quantidade, intervalo, parar):
+    # Abre as ligacoes e vai enviando um cabecalho de cada vez ate ser pedido para parar
+    ligacoes = []
+    for i in range(quantidade):
+        try:
+            ligacao = socket.create_connection((url.hostname, url.port or 80), timeout=10)
+            ligacao.sendall(f'GET /search_song/x HTTP/1.1\r\nHost: {url.hostname}\r\n'.encode())
+            ligacoes.append(ligacao)
+        except OSError:
+            break
+    print(f'{len(ligacoes)} slow clients connected')
+
+    i = 0
+    while not parar.wait(intervalo):
+        for ligacao in list(ligacoes):
+            try:
+                ligacao.sendall(f'X-Slow-{i}: 1\r\n'.encode())
+            except OSError:
+                ligacoes.remove(ligacao)
+        i += 1
+    print(f'{len(ligacoes)} slow clients still connected at the end')
+    for ligacao in ligacoes:
+        ligacao.close()
+
+
+def benchmark_http(args):
+    passos = cenarios(args)[args.scenario]
+    url = urllib.parse.urlparse(args.url)
+    ligacao = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    token = login(ligacao, args.username, args.password)
+    ligacao.close()
+
+    parar = threading.Event()
+    lentos = None
+    if args.slow_clients:
+        lentos = threading.Thread(target=clientes_lentos, args=(url, args.slow_clients, args.slow_interval, parar))
+        lentos.start()
+        time.sleep(args.slow_interval)
+
+    print(f'scenario={args.scenario} duration={args.duration}s slow_clients={args.slow_clients}')
+    print(f'{"clients":>8} {"requests":>9} {"errors":>7} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    try:
+        for clientes in [int(c) for c in args.clients.split(',')]:
+            r = corre(args, token, passos, clientes)
+            print(f'{r["clients"]:>8} {r["requests"]:>9} {r["errors"]:>7} {r["throughput"]:>9.1f} '
+                  f'{r["p50"]:>8.1f} {r["p95"]:>8.1f} {r["p99"]:>8.1f}')
+    finally:
+        parar.set()
+        if lentos is not None:
+            lentos.join()
+
+
+def liga_base_de_dados():
+    import psycopg2
+
+    with open('config.txt', 'r') as arquivo:
+        lista = [linha.strip() for linha in arquivo]
+    return psycopg2.connect(user=lista[0], password=lista[1], host=lista[2], port=lista[3], database=lista[4])
+
+
+CONSULTA_ARTISTA_ANTIGA = """
+    SELECT
+        a.nome AS nome,
+        ARRAY_AGG(DISTINCT m.ismn) AS musicas,
+        ARRAY_AGG(DISTINCT al.id) AS albums,
+        ARRAY_AGG(DISTINCT p.id) AS playlists
+    FROM artista AS a
+    LEFT JOIN artista_musica AS am ON am.artista_utilizador_id = a.utilizador_id
+    LEFT JOIN musica AS m ON m.ismn = am.musica_ismn
+    LEFT JOIN album_artista AS aa ON aa.artista_utilizador_id = a.utilizador_id
+    LEFT JOIN album AS al ON al.id = aa.album_id
+    LEFT JOIN musica_playlist AS mp ON mp.musica_ismn = m.ismn
+    LEFT JOIN playlist AS p ON p.id = mp.playlist_id and p.visibilidade=true
+    WHERE a.utilizador_id = %s
+    GROUP BY a.utilizador_id
+"""
+
+CONSULTA_ARTISTA_NOVA = """
+    SELECT
+        a.nome AS nome,
+        ARRAY(
+            SELECT am.musica_ismn
+            FROM artista_musica AS am
+            WHERE am.artista_utilizador_id = a.utilizador_id
+            ORDER BY am.musica_ismn
+        ) AS musicas,
+        ARRAY(
+            SELECT aa.album_id
+            FROM album_artista AS aa
+            WHERE aa.artista_utilizador_id = a.utilizador_id
+            ORDER BY aa.album_id
+        ) AS albums,
+        ARRAY(
+            SELECT DISTINCT p.id
+            FROM artista_musica AS am
+            INNER JOIN musica_playlist AS mp ON mp.musica_ismn = am.musica_ismn
+            INNER JOIN playlist AS p ON p.id = mp.playlist_id AND p.visibilidade = true
+            WHERE am.artista_utilizador_id = a.utilizador_id
+            ORDER BY p.id
+        ) AS playlists
+    FROM artista AS a
+    WHERE a.utilizador_id = %s
+"""
+
+
+def cria_artista_sintetico(cur, musicas, albuns, playlists, musicas_por_playlist):
+    cur.execute("INSERT INTO gravadora (nome) VALUES ('benchmark') RETURNING id")
+    gravadora = cur.fetchone()[0]
+
+    ids = []
+    for nome in ('benchmark_admin', 'benchmark_artist', 'benchmark_consumer'):
+        cur.execute('INSERT INTO utilizador (username, palavra_passe) VALUES (%s, %s) RETURNING id', (nome, ''))
+        ids.append(cur.fetchone()[0])
+    admin, artista, consumidor = ids
+    cur.execute('INSERT INTO administrador (utilizador_id) VALUES (%s)', (admin,))
+    cur.execute('INSERT INTO artista (nome, nome_artistico, administrador_utilizador_id, utilizador_id) '
+                'VALUES (%s, %s, %s, %s)', ('Benchmark', 'Benchmark', admin, artista))
+    cur.execute('INSERT INTO consumidor (nome, utilizador_id) VALUES (%s, %s)', ('Benchmark', consumidor))
+
+    cur.execute("""
+        WITH novas AS (
+            INSERT INTO musica (titulo, genero, duracao, data_de_lancamento, gravadora_id)
+            SELECT 'benchmark ' || g, 'pop', 180, CURRENT_DATE, %s FROM generate_series(1, %s) AS g
+            RETURNING ismn
+        )
+        INSERT INTO artista_musica (artista_utilizador_id, musica_ismn) SELECT %s, ismn FROM novas
+    """, (gravadora, musicas, artista))
+    cur.execute("""
+        WITH novos AS (
+            INSERT INTO album (titulo, data_de_lancamento, gravadora_id)
+            SELECT 'benchmark ' || g, CURRENT_DATE, %s FROM generate_series(1, %s) AS g
+            RETURNING id
+        )
+        INSERT INTO album_artista (album_id, artista_utilizador_id) SELECT id, %s FROM novos
+    """, (gravadora, albuns, artista))
+    cur.execute("""
+        WITH novas AS (
+            INSERT INTO playlist (nome, visibilidade, consumidor_utilizador_id)
+            SELECT 'benchmark ' || g, true, %s FROM generate_series(1, %s) AS g
+            RETURNING id
+        )
+        INSERT INTO musica_playlist (musica_ismn, playlist_id)
+        SELECT escolhidas.musica_ismn, p.id
+        FROM novas AS p
+        CROSS JOIN LATERAL (
+            SELECT am.musica_ismn
+            FROM artista_musica AS am
+            WHERE am.artista_utilizador_id = %s
+            ORDER BY md5(am.musica_ismn::TEXT || p.id::TEXT)
+            LIMIT %s
+        ) AS escolhidas
+    """, (consumidor, playlists, artista, musicas_por_playlist))
+    for tabela in ('artista_musica', 'album_artista', 'musica_playlist', 'playlist'):
+        cur.execute(f'ANALYZE {tabela}')
+    return artista
+
+
+def mede_consulta(cur, consulta, artista, repeticoes):
+    tempos = []
+    for i in range(repeticoes):
+        inicio = time.perf_counter()
+        cur.execute(consulta, (artista,))
+        cur.fetchall()
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    return tempos
+
+
+def benchmark_artist_query(args):
+    conn = liga_base_de_dados()
+    cur = conn.cursor()
+    try:
+        artista = cria_artista_sintetico(cur, args.songs, args.albums, args.playlists, args.songs_per_playlist)
+        # Linhas que a consulta antiga junta antes do GROUP BY: albuns x (playlists de cada musica, ou 1)
+        cur.execute('SELECT SUM(GREATEST(n, 1)) FROM ('
+                    '  SELECT am.musica_ismn, COUNT(mp.playlist_id) AS n FROM artista_musica am'
+                    '  LEFT JOIN musica_playlist mp ON mp.musica_ismn = am.musica_ismn'
+                    '  WHERE am.artista_utilizador_id = %s GROUP BY am.musica_ismn) AS por_musica', (artista,))
+        linhas = cur.fetchone()[0]
+        print(f'artist with {args.songs} songs, {args.albums} albums; '
+              f'old query joins {linhas * args.albums} rows before grouping')
+        print(f'{"query":>6} {"min ms":>9} {"median ms":>10} {"max ms":>9}')
+        for nome, consulta in (('old', CONSULTA_ARTISTA_ANTIGA), ('new', CONSULTA_ARTISTA_NOVA)):
+            tempos = mede_consulta(cur, consulta, artista, args.repeat)
+            print(f'{nome:>6} {min(tempos):>9.1f} {statistics.median(tempos):>10.1f} {max(tempos):>9.1f}')
+    finally:
+        # Nada do que foi criado fica na base de dados
+        conn.rollback()
+        conn.close()
+
+
+def album_musica_a_musica(cur, gravadora, artista, novas, existentes):
+    cur.execute('INSERT INTO album (titulo, data_de_lancamento,gravadora_id) VALUES (%s, %s,%s) RETURNING id',
+                ('benchmark', '2023-01-01', gravadora))
+    album_id = cur.fetchone()[0]
+    for song in novas:
+        cur.execute('INSERT INTO musica (titulo,genero,duracao,data_de_lancamento, gravadora_id) '
+                    'VALUES (%s, %s, %s, %s, %s) RETURNING ismn', song)
+        song_id = cur.fetchone()[0]
+        cur.executemany('INSERT INTO artista_musica (artista_utilizador_id,musica_ismn) VALUES (%s, %s)',
+                        [(artista, song_id)])
+        cur.execute('INSERT INTO musica_album (musica_ismn,album_id) VALUES (%s, %s)', (song_id, album_id))
+    for song_id in existentes:
+        cur.execute('SELECT COUNT(*) FROM musica WHERE ismn = %s', (song_id,))
+        cur.fetchone()
+        cur.execute('INSERT INTO musica_album (musica_ismn,album_id) VALUES (%s, %s)', (song_id, album_id))
+    cur.execute('INSERT INTO album_artista (album_id, artista_utilizador_id) VALUES (%s, %s)', (album_id, artista))
+
+
+def carrega_api():
+    # O ficheiro da API tem espacos no nome e nao pode ser importado com import; carrega-lo nao arranca
+    # o servidor nem abre ligacoes
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location('projeto', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                          'projeto (1).py'))
+    api = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(api)
+    return api
+
+
+def album_em_lote(api):
+    # O mesmo caminho do /add_album: validar as musicas existentes e inserir o album com insere_album
+    def insere(cur, gravadora, artista, novas, existentes):
+        api.musicas_em_falta(cur, existentes)
+        musicas = [{'name': titulo, 'type': genero, 'duration': duracao, 'release_date': data, 'publisher': editora}
+                   for titulo, genero, duracao, data, editora in novas]
+        api.insere_album(cur, artista, 'benchmark', '2023-01-01', gravadora, musicas, existentes)
+    return insere
+
+
+def benchmark_album_import(args):
+    em_lote = album_em_lote(carrega_api())
+    conn = liga_base_de_dados()
+    cur = conn.cursor()
+    try:
+        artista = cria_artista_sintetico(cur, 1000, 0, 0, 0)
+        cur.execute('SELECT gravadora_id FROM musica WHERE ismn = (SELECT MIN(musica_ismn) FROM artista_musica '
+                    'WHERE artista_utilizador_id = %s)', (artista,))
+        gravadora = cur.fetchone()[0]
+        cur.execute('SELECT musica_ismn FROM artista_musica WHERE artista_utilizador_id = %s', (artista,))
+        catalogo = [linha[0] for linha in cur.fetchall()]
+
+        print(f'{"tracks":>7} {"per-song ms":>12} {"batched ms":>11} {"speedup":>8}')
+        for faixas in [int(n) for n in args.tracks.split(',')]:
+            # Um decimo das faixas sao musicas ja existentes, como numa compilacao
+            n_existentes = min(faixas // 10, len(catalogo))
+            existentes = catalogo[:n_existentes]
+            novas = [(f'benchmark {i}', 'pop', 180, '2023-01-01', gravadora) for i in range(faixas - n_existentes)]
+
+            resultados = []
+            for funcao in (album_musica_a_musica, em_lote):
+                tempos = []
+                for i in range(args.repeat):
+                    cur.execute('SAVEPOINT album')
+                    inicio = time.perf_counter()
+                    funcao(cur, gravadora, artista, novas, existentes)
+                    tempos.append((time.perf_counter() - inicio) * 1000)
+                    cur.execute('ROLLBACK TO SAVEPOINT album')
+                resultados.append(statistics.median(tempos))
+            print(f'{faixas:>7} {resultados[0]:>12.1f} {resultados[1]:>11.1f} {resultados[0] / resultados[1]:>7.1f}x')
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+# Instrucoes de cada endpoint, pelo nome em Consultas: as mesmas que a API prepara
+INSTRUCOES_PREPARADAS = {
+    'play_song': ['bloqueia_consumidor', 'musica_titulo', 'insere_reproducao'],
+    'make_comment': ['insere_comentario'],
+    'authentication': ['utilizador_por_username']
+}
+
+
+def benchmark_prepared(args):
+    conn = liga_base_de_dados()
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT c.utilizador_id, u.username FROM consumidor AS c '
+                    'INNER JOIN utilizador AS u ON u.id = c.utilizador_id LIMIT 1')
+        consumidor = cur.fetchone()
+        cur.execute('SELECT ismn FROM musica LIMIT 1')
+        musica = cur.fetchone()
+        if consumidor is None or musica is None:
+            raise SystemExit('the database needs at least one consumer and one song')
+        parametros = {
+            'bloqueia_consumidor': (consumidor[0],),
+            'musica_titulo': (musica[0],),
+            'insere_reproducao': (time.strftime('%Y-%m-%d'), consumidor[0], musica[0]),
+            'insere_comentario': ('benchmark', time.strftime('%Y-%m-%d'), musica[0], consumidor[0], None),
+            'utilizador_por_username': (consumidor[1],)
+        }
+
+        print(f'{"endpoint":>15} {"text us/call":>13} {"prepared us/call":>17} {"speedup":>8}')
+        for endpoint, nomes in INSTRUCOES_PREPARADAS.items():
+            instrucoes = [(nome,) + Consultas[nome] for nome in nomes]
+            for nome, tipos, sql in instrucoes:
+                cur.execute(f'PREPARE {nome} ({", ".join(tipos)}) AS {sql}')
+
+            tempos = []
+            for preparada in (False, True):
+                inicio = time.perf_counter()
+                for i in range(args.repeat):
+                    for nome, tipos, sql in instrucoes:
+                        valores = parametros[nome]
+                        if preparada:
+                            cur.execute(f'EXECUTE {nome} ({", ".join(["%s"] * len(valores))})', valores)
+                        else:
+                            cur.execute(re.sub(r'\$(\d+)', r'%(\1)s', sql),
+                                        {str(j): valor for j, valor in enumerate(valores, start=1)})
+                tempos.append((time.perf_counter() - inicio) / args.repeat * 1e6)
+            print(f'{endpoint:>15} {tempos[0]:>13.1f} {tempos[1]:>17.1f} {tempos[0] / tempos[1]:>7.2f}x')
+    finally:
+        # Nada do que foi inserido fica na base de dados
+        conn.rollback()
+        conn.close()
+
+
+def benchmark_kdf(args):
+    def um_hash(i):
+        inicio = time.perf_counter()
+        salt = i.to_bytes(16, 'big')
+        if args.algorithm == 'pbkdf2_sha256':
+            hashlib.pbkdf2_hmac('sha256', b'palavra-passe', salt, args.cost)
+        else:
+            hashlib.scrypt(b'palavra-passe', salt=salt, n=args.cost, r=8, p=1,
+                           maxmem=128 * 8 * (args.cost + 3) + 1024 * 1024, dklen=32)
+        return time.perf_counter() - inicio
+
+    print(f'algorithm={args.algorithm} cost={args.cost} hashes={args.hashes}')
+    print(f'{"threads":>8} {"hashes/s":>9} {"p50 ms":>8} {"p99 ms":>8}')
+    for threads in [int(t) for t in args.threads.split(',')]:
+        inicio = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            latencias = sorted(executor.map(um_hash, range(args.hashes)))
+        decorrido = time.perf_counter() - inicio
+        print(f'{threads:>8} {args.hashes / decorrido:>9.1f} {percentil(latencias, 50) * 1000:>8.1f} '
+              f'{percentil(latencias, 99) * 1000:>8.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='API and query benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    http_parser = subparsers.add_parser('http', help='concurrent clients against a running server')
+    http_parser.add_argument('--url', default='http://127.0.0.1:8080')
+    http_parser.add_argument('--username', required=True)
+    http_parser.add_argument('--password', required=True)
+    http_parser.add_argument('--scenario', default='mixed')
+    http_parser.add_argument('--clients', default='1,2,4,8,16,32')
+    http_parser.add_argument('--duration', type=float, default=10)
+    http_parser.add_argument('--song', default='1')
+    http_parser.add_argument('--keyword', default='a')
+    http_parser.add_argument('--artist', default='1')
+    http_parser.add_argument('--year_month', default=time.strftime('%Y-%m'))
+    http_parser.add_argument('--slow_clients', type=int, default=0)
+    http_parser.add_argument('--slow_interval', type=float, default=5)
+    http_parser.set_defaults(funcao=benchmark_http)
+
+    artist_parser = subparsers.add_parser('artist_query', help='old vs new /artist_info query on a synthetic artist')
+    artist_parser.add_argument('--songs', type=int, default=2000)
+    artist_parser.add_argument('--albums', type=int, default=200)
+    artist_parser.add_argument('--playlists', type=int, default=200)
+    artist_parser.add_argument('--songs_per_playlist', type=int, default=20)
+    artist_parser.add_argument('--repeat', type=int, default=5)
+    artist_parser.set_defaults(funcao=benchmark_artist_query)
+
+    album_parser = subparsers.add_parser('album_import', help='per-song vs batched album inserts')
+    album_parser.add_argument('--tracks', default='10,100,1000')
+    album_parser.add_argument('--repeat', type=int, default=5)
+    album_parser.set_defaults(funcao=benchmark_album_import)
+
+    prepared_parser = subparsers.add_parser('prepared', help='text vs prepared statements of the hot endpoints')
+    prepared_parser.add_argument('--repeat', type=int, default=2000)
+    prepared_parser.set_defaults(funcao=benchmark_prepared)
+
+    kdf_parser = subparsers.add_parser('kdf', help='password hash cost per thread count')
+    kdf_parser.add_argument('--algorithm', choices=['scrypt', 'pbkdf2_sha256'], default='scrypt')
+    kdf_parser.add_argument('--cost', type=int, default=2 ** 14, help='scrypt n or PBKDF2 iterations')
+    kdf_parser.add_argument('--hashes', type=int, default=64)
+    kdf_parser.add_argument('--threads', default='1,2,4,8')
+    kdf_parser.set_defaults(funcao=benchmark_kdf)
+
+    args = parser.parse_args()
+    args.funcao(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -137,6 +137,27 @@ CREATE TABLE musica_album (
 	PRIMARY KEY(musica_ismn,album_id)
 );
 
+CREATE TABLE reproducoes_mes_genero (
+	mes		 DATE,
+	genero	 VARCHAR(512),
+	particao	 SMALLINT,
+	reproducoes BIGINT NOT NULL DEFAULT 0,
+	PRIMARY KEY(mes,genero,particao)
+);
+
+CREATE TABLE plano_atual (
+	consumidor_utilizador_id INTEGER,
+	data_de_validade	 DATE,
+	PRIMARY KEY(consumidor_utilizador_id)
+);
+
+CREATE TABLE contagem_consumidor_musica (
+	consumidor_utilizador_id INTEGER,
+	musica_ismn		 INTEGER,
+	reproducoes		 BIGINT NOT NULL DEFAULT 0,
+	PRIMARY KEY(consumidor_utilizador_id,musica_ismn)
+);
+
 ALTER TABLE consumidor ADD CONSTRAINT consumidor_fk1 FOREIGN KEY (utilizador_id) REFERENCES utilizador(id);
 ALTER TABLE subscricao ADD CONSTRAINT subscricao_fk1 FOREIGN KEY (consumidor_utilizador_id) REFERENCES consumidor(utilizador_id);
 ALTER TABLE cartao_pre_pago ADD CONSTRAINT cartao_pre_pago_fk1 FOREIGN KEY (administrador_utilizador_id) REFERENCES administrador(utilizador_id);
@@ -162,6 +183,9 @@ ALTER TABLE artista_musica ADD CONSTRAINT artista_musica_fk1 FOREIGN KEY (artist
 ALTER TABLE artista_musica ADD CONSTRAINT artista_musica_fk2 FOREIGN KEY (musica_ismn) REFERENCES musica(ismn);
 ALTER TABLE musica_album ADD CONSTRAINT musica_album_fk1 FOREIGN KEY (musica_ismn) REFERENCES musica(ismn);
 ALTER TABLE musica_album ADD CONSTRAINT musica_album_fk2 FOREIGN KEY (album_id) REFERENCES album(id);
+ALTER TABLE plano_atual ADD CONSTRAINT plano_atual_fk1 FOREIGN KEY (consumidor_utilizador_id) REFERENCES consumidor(utilizador_id);
+ALTER TABLE contagem_consumidor_musica ADD CONSTRAINT contagem_consumidor_musica_fk1 FOREIGN KEY (consumidor_utilizador_id) REFERENCES consumidor(utilizador_id);
+ALTER TABLE contagem_consumidor_musica ADD CONSTRAINT contagem_consumidor_musica_fk2 FOREIGN KEY (musica_ismn) REFERENCES musica(ismn);
 
 
 
@@ -196,38 +220,230 @@ ALTER COLUMN id SET DEFAULT nextval('ids_contagem_musica');
 
 
 
+----------------------------------INDICES----------------------------------------------
+
+-- Pesquisa de músicas por título e nome artístico (ILIKE '%palavra%')
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX musica_titulo_trgm_idx ON musica USING GIN (titulo gin_trgm_ops);
+CREATE INDEX artista_nome_artistico_trgm_idx ON artista USING GIN (nome_artistico gin_trgm_ops);
+-- Artistas de uma música e álbuns de uma música (as chaves primárias começam pelo artista/música)
+CREATE INDEX artista_musica_musica_idx ON artista_musica (musica_ismn);
+
+-- Subscrições de um consumidor, da mais recente para a mais antiga
+CREATE INDEX subscricao_consumidor_validade_idx ON subscricao (consumidor_utilizador_id, data_de_validade DESC);
+
+-- /artist_info: álbuns de um artista. As músicas de um artista (artista_musica) e as playlists
+-- de uma música (musica_playlist) já usam as chaves primárias, que começam por essas colunas
+CREATE INDEX album_artista_artista_idx ON album_artista (artista_utilizador_id);
+
+-- TOP10 de cada consumidor lido diretamente do indice
+CREATE INDEX contagem_consumidor_musica_top_idx ON contagem_consumidor_musica (consumidor_utilizador_id, reproducoes DESC, musica_ismn);
+
+-- A playlist TOP10 do consumidor e as suas músicas são procuradas a cada reprodução
+-- (a chave primária de musica_playlist começa pela música, não serve para as músicas de uma playlist)
+CREATE INDEX playlist_consumidor_nome_idx ON playlist (consumidor_utilizador_id, nome);
+CREATE INDEX musica_playlist_playlist_idx ON musica_playlist (playlist_id);
+
+-- GET /comment: comentarios de uma musica por ordem de criacao, e saber se um comentario e resposta.
+-- As respostas de um comentario (comentario_comentario por comentario_id) ja usam a chave primaria
+CREATE INDEX comentario_musica_idx ON comentario (musica_ismn, id);
+CREATE INDEX comentario_comentario_resposta_idx ON comentario_comentario (comentario_id1);
+
+-- /login: um utilizador por username (e a procura pelo username passa a usar o indice)
+CREATE UNIQUE INDEX utilizador_username_idx ON utilizador (username);
+
+
+
+
 ----------------------------------Trigger----------------------------------------------
 
-BEGIN
-    -- Limpar as entradas anteriores na tabela musica_playlist
-    DELETE FROM musica_playlist
-    WHERE playlist_id IN (
-        SELECT id
-        FROM playlist
-        WHERE nome = 'TOP10' AND consumidor_utilizador_id = NEW.consumidor_utilizador_id
-    );
+-- Cada reprodução soma 1 ao agregado (consumidor, música) em vez de recontar todo o histórico,
+-- e a playlist TOP10 só é alterada quando o conjunto das 10 músicas mais ouvidas muda.
+-- Em caso de empate ganha a música com menor ismn, para a playlist não oscilar.
 
-    -- Selecionar as 10 músicas mais frequentes para o consumidor
-    WITH top_10 AS (
+CREATE OR REPLACE FUNCTION refresca_top_10(consumidor INTEGER, musica INTEGER DEFAULT NULL)
+RETURNS VOID AS $$
+DECLARE
+    id_top10 INTEGER;
+    novo_top INTEGER[];
+BEGIN
+    SELECT id INTO id_top10
+    FROM playlist
+    WHERE nome = 'TOP10' AND consumidor_utilizador_id = consumidor;
+
+    IF id_top10 IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- Se a música reproduzida já está no TOP10, só a sua contagem subiu e o conjunto não muda
+    IF musica IS NOT NULL AND EXISTS (
+        SELECT 1 FROM musica_playlist WHERE playlist_id = id_top10 AND musica_ismn = musica
+    ) THEN
+        RETURN;
+    END IF;
+
+    -- O novo TOP10 sai do indice contagem_consumidor_musica_top_idx
+    novo_top := ARRAY(
         SELECT musica_ismn
-        FROM contagem_musica
-        WHERE consumidor_utilizador_id = NEW.consumidor_utilizador_id
-        GROUP BY musica_ismn
-        ORDER BY COUNT(*) DESC
+        FROM contagem_consumidor_musica
+        WHERE consumidor_utilizador_id = consumidor
+        ORDER BY reproducoes DESC, musica_ismn
         LIMIT 10
-    )
-    -- Inserir as entradas na tabela musica_playlist
-    INSERT INTO musica_playlist (playlist_id, musica_ismn)
-    SELECT p.id, t.musica_ismn
-    FROM playlist p
-    CROSS JOIN top_10 t
-    WHERE p.nome = 'TOP10' AND p.consumidor_utilizador_id = NEW.consumidor_utilizador_id;
+    );
+
+    -- Na maior parte das reproduções o conjunto não muda e a playlist não é escrita
+    IF NOT EXISTS (
+        SELECT musica_ismn FROM musica_playlist WHERE playlist_id = id_top10
+        EXCEPT
+        SELECT unnest(novo_top)
+    ) AND NOT EXISTS (
+        SELECT unnest(novo_top)
+        EXCEPT
+        SELECT musica_ismn FROM musica_playlist WHERE playlist_id = id_top10
+    ) THEN
+        RETURN;
+    END IF;
+
+    -- Remover as músicas que saíram do TOP10
+    DELETE FROM musica_playlist
+    WHERE playlist_id = id_top10
+      AND musica_ismn <> ALL (novo_top);
+
+    -- Inserir as que entraram, pela ordem da chave
+    INSERT INTO musica_playlist (musica_ismn, playlist_id)
+    SELECT musica_ismn, id_top10 FROM unnest(novo_top) AS musica_ismn
+    ORDER BY musica_ismn
+    ON CONFLICT (musica_ismn, playlist_id) DO NOTHING;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Variante por linha: uma reprodução de cada vez
+CREATE OR REPLACE FUNCTION atualizar_top_10()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO contagem_consumidor_musica (consumidor_utilizador_id, musica_ismn, reproducoes)
+    VALUES (NEW.consumidor_utilizador_id, NEW.musica_ismn, 1)
+    ON CONFLICT (consumidor_utilizador_id, musica_ismn)
+    DO UPDATE SET reproducoes = contagem_consumidor_musica.reproducoes + 1;
+
+    PERFORM refresca_top_10(NEW.consumidor_utilizador_id, NEW.musica_ismn);
 
     RETURN NULL;
 END;
+$$ LANGUAGE plpgsql;
+
+
+-- Variante por instrução: agrega todas as linhas de um INSERT com várias reproduções
+-- (ingestão em lote) e refresca o TOP10 uma vez por consumidor. Quando o consumidor só ouviu
+-- uma música no lote (o caso de PUT /<song>), ela é passada para o atalho de refresca_top_10.
+-- As linhas são escritas pela ordem da chave, e os TOP10 pela ordem do consumidor: dois lotes
+-- gravados ao mesmo tempo (um por worker) bloqueiam as linhas comuns pela mesma ordem e não
+-- ficam presos um à espera do outro
+CREATE OR REPLACE FUNCTION atualizar_top_10_lote()
+RETURNS TRIGGER AS $$
+DECLARE
+    consumidor INTEGER;
+    musica INTEGER;
+BEGIN
+    INSERT INTO contagem_consumidor_musica (consumidor_utilizador_id, musica_ismn, reproducoes)
+    SELECT consumidor_utilizador_id, musica_ismn, COUNT(*)
+    FROM novas_reproducoes
+    GROUP BY consumidor_utilizador_id, musica_ismn
+    ORDER BY consumidor_utilizador_id, musica_ismn
+    ON CONFLICT (consumidor_utilizador_id, musica_ismn)
+    DO UPDATE SET reproducoes = contagem_consumidor_musica.reproducoes + EXCLUDED.reproducoes;
+
+    FOR consumidor, musica IN
+        SELECT consumidor_utilizador_id,
+               CASE WHEN COUNT(DISTINCT musica_ismn) = 1 THEN MIN(musica_ismn) END
+        FROM novas_reproducoes
+        GROUP BY consumidor_utilizador_id
+        ORDER BY 1
+    LOOP
+        PERFORM refresca_top_10(consumidor, musica);
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Só uma das variantes pode estar ativa; a variante por instrução serve tanto para
+-- inserções de uma linha como para lotes. Para usar a variante por linha:
+--   CREATE OR REPLACE TRIGGER atualizar_top_10_trigger
+--   AFTER INSERT ON contagem_musica
+--   FOR EACH ROW
+--   EXECUTE FUNCTION atualizar_top_10();
+DROP TRIGGER IF EXISTS atualizar_top_10_trigger ON contagem_musica;
+
+CREATE OR REPLACE TRIGGER atualizar_top_10_lote_trigger
+AFTER INSERT ON contagem_musica
+REFERENCING NEW TABLE AS novas_reproducoes
+FOR EACH STATEMENT
+EXECUTE FUNCTION atualizar_top_10_lote();
+
+
+-- Reproduções por mês e género para o relatório mensal. Músicas sem género ficam com genero = ''.
+-- Cada (mês, género) está dividido em 8 partições escolhidas pelo consumidor, para que
+-- reproduções simultâneas do mesmo género não fiquem todas à espera da mesma linha;
+-- o relatório soma as partições. As linhas são escritas pela ordem da chave, para dois lotes
+-- gravados ao mesmo tempo não bloquearem as mesmas linhas por ordens diferentes.
+CREATE OR REPLACE FUNCTION atualizar_reproducoes_mes_genero()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO reproducoes_mes_genero (mes, genero, particao, reproducoes)
+    SELECT date_trunc('month', n.data)::DATE, COALESCE(m.genero, ''), n.consumidor_utilizador_id % 8, COUNT(*)
+    FROM novas_reproducoes n
+    INNER JOIN musica m ON m.ismn = n.musica_ismn
+    GROUP BY 1, 2, 3
+    ORDER BY 1, 2, 3
+    ON CONFLICT (mes, genero, particao)
+    DO UPDATE SET reproducoes = reproducoes_mes_genero.reproducoes + EXCLUDED.reproducoes;
 
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
 
-CREATE  OR REPLACE TRIGGER atualizar_top_10_trigger
+CREATE OR REPLACE TRIGGER atualizar_reproducoes_mes_genero_trigger
 AFTER INSERT ON contagem_musica
+REFERENCING NEW TABLE AS novas_reproducoes
+FOR EACH STATEMENT
+EXECUTE FUNCTION atualizar_reproducoes_mes_genero();
+
+
+-- Plano atual de cada consumidor: a maior data de validade entre as suas subscrições
+-- (NULL enquanto só tiver a subscrição Regular criada com a conta)
+CREATE OR REPLACE FUNCTION atualizar_plano_atual()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO plano_atual (consumidor_utilizador_id, data_de_validade)
+    VALUES (NEW.consumidor_utilizador_id, NEW.data_de_validade)
+    ON CONFLICT (consumidor_utilizador_id)
+    DO UPDATE SET data_de_validade = GREATEST(plano_atual.data_de_validade, EXCLUDED.data_de_validade);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER atualizar_plano_atual_trigger
+AFTER INSERT ON subscricao
 FOR EACH ROW
-EXECUTE FUNCTION atualizar_top_10()
+EXECUTE FUNCTION atualizar_plano_atual();
+
+
+-- Migração de uma base de dados existente: preencher os agregados, reconstruir os TOP10 e o plano atual
+-- (o agregado mensal é preenchido com `python "projeto (1).py" backfill_report`)
+INSERT INTO contagem_consumidor_musica (consumidor_utilizador_id, musica_ismn, reproducoes)
+SELECT consumidor_utilizador_id, musica_ismn, COUNT(*)
+FROM contagem_musica
+GROUP BY consumidor_utilizador_id, musica_ismn
+ON CONFLICT (consumidor_utilizador_id, musica_ismn) DO NOTHING;
+
+SELECT refresca_top_10(utilizador_id) FROM consumidor;
+
+INSERT INTO plano_atual (consumidor_utilizador_id, data_de_validade)
+SELECT consumidor_utilizador_id, MAX(data_de_validade)
+FROM subscricao
+GROUP BY consumidor_utilizador_id
+ON CONFLICT (consumidor_utilizador_id) DO NOTHING;
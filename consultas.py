@@ -0,0 +1,62 @@
+"""Instrucoes preparadas da API, partilhadas com benchmark.py.
+
+Consultas: nome -> (tipos dos parametros $1, $2, ..., SQL). Sao preparadas na primeira utilizacao em
+cada ligacao e o PostgreSQL reutiliza a analise e, depois de algumas execucoes, o plano.
+"""
+
+Consultas = {
+    'musica_titulo': (
+        ('INTEGER',),
+        'SELECT titulo FROM musica WHERE ismn = $1'),
+    'musica_existe': (
+        ('INTEGER',),
+        'SELECT ismn FROM musica WHERE ismn = $1'),
+    'bloqueia_consumidor': (
+        ('INTEGER',),
+        'SELECT utilizador_id FROM consumidor WHERE utilizador_id = $1 FOR NO KEY UPDATE'),
+    'insere_reproducao': (
+        ('DATE', 'INTEGER', 'INTEGER'),
+        'INSERT INTO contagem_musica (data, consumidor_utilizador_id, musica_ismn) VALUES ($1, $2, $3)'),
+    'plano_atual': (
+        ('INTEGER',),
+        'SELECT data_de_validade FROM plano_atual WHERE consumidor_utilizador_id = $1'),
+    'utilizador_por_username': (
+        ('VARCHAR',),
+        '''
+        SELECT
+            u.palavra_passe,
+            u.id,
+            CASE
+                WHEN c.utilizador_id IS NOT NULL THEN 'consumidor'
+                WHEN a.utilizador_id IS NOT NULL THEN 'artista'
+                WHEN ad.utilizador_id IS NOT NULL THEN 'administrador'
+            END AS tipo
+        FROM utilizador AS u
+        LEFT JOIN consumidor AS c ON c.utilizador_id = u.id
+        LEFT JOIN artista AS a ON a.utilizador_id = u.id
+        LEFT JOIN administrador AS ad ON ad.utilizador_id = u.id
+        WHERE u.username = $1
+        '''),
+    'palavra_passe_por_id': (
+        ('INTEGER',),
+        'SELECT palavra_passe FROM utilizador WHERE id = $1'),
+    # $1 texto, $2 data, $3 musica, $4 consumidor, $5 comentario pai (NULL num comentario de topo)
+    'insere_comentario': (
+        ('VARCHAR', 'DATE', 'INTEGER', 'INTEGER', 'INTEGER'),
+        '''
+        WITH pai AS (
+            SELECT musica_ismn FROM comentario WHERE id = $5
+        ),
+        novo AS (
+            INSERT INTO comentario (texto, data_de_criacao, musica_ismn, consumidor_utilizador_id)
+            SELECT $1, $2, $3, $4
+            WHERE $5 IS NULL OR EXISTS (SELECT 1 FROM pai WHERE musica_ismn = $3)
+            RETURNING id
+        ),
+        resposta AS (
+            INSERT INTO comentario_comentario (comentario_id, comentario_id1)
+            SELECT $5, id FROM novo WHERE $5 IS NOT NULL
+        )
+        SELECT (SELECT id FROM novo), (SELECT musica_ismn FROM pai)
+        ''')
+}
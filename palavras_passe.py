@@ -0,0 +1,49 @@
+"""Hash das palavras-passe dos utilizadores.
+
+Os hashes novos sao "scrypt$n$r$p$salt$hash" ou "pbkdf2_sha256$iteracoes$salt$hash" (salt e hash em
+hexadecimal). Os hashes antigos, o SHA-256 da palavra-passe sem salt, continuam a ser aceites e sao
+marcados para serem recalculados. `configuracao` e um dicionario como PasswordHashing da API.
+"""
+import hashlib
+import secrets
+
+
+def novos_parametros(configuracao):
+    # Algoritmo, custo e um salt novo, como ficam guardados antes do hash
+    salt = secrets.token_hex(16)
+    if configuracao['algorithm'] == 'pbkdf2_sha256':
+        return ['pbkdf2_sha256', str(configuracao['pbkdf2_iterations']), salt]
+    return ['scrypt', str(configuracao['scrypt_n']), str(configuracao['scrypt_r']), str(configuracao['scrypt_p']), salt]
+
+
+def calcula_hash(palavra_passe, parametros):
+    if parametros[0] == 'pbkdf2_sha256':
+        iteracoes, salt = int(parametros[1]), parametros[2]
+        chave = hashlib.pbkdf2_hmac('sha256', palavra_passe.encode('utf-8'), bytes.fromhex(salt), iteracoes)
+    elif parametros[0] == 'scrypt':
+        n, r, p, salt = int(parametros[1]), int(parametros[2]), int(parametros[3]), parametros[4]
+        chave = hashlib.scrypt(palavra_passe.encode('utf-8'), salt=bytes.fromhex(salt), n=n, r=r, p=p,
+                               maxmem=128 * r * (n + p + 2) + 1024 * 1024, dklen=32)
+    else:
+        raise ValueError(f'unknown password hash algorithm {parametros[0]}')
+    return '$'.join(parametros + [chave.hex()])
+
+
+def gera_hash(palavra_passe, configuracao):
+    return calcula_hash(palavra_passe, novos_parametros(configuracao))
+
+
+def confirma_hash(palavra_passe, guardado, configuracao):
+    # Devolve (palavra-passe certa, hash deve ser recalculado com o algoritmo e custo atuais)
+    if '$' not in guardado:
+        antigo = hashlib.sha256(palavra_passe.encode('utf-8')).hexdigest()
+        return secrets.compare_digest(antigo, guardado), True
+
+    parametros = guardado.split('$')[:-1]
+    try:
+        certa = secrets.compare_digest(calcula_hash(palavra_passe, parametros), guardado)
+    except (ValueError, IndexError):
+        # Hash guardado num formato que nao se reconhece
+        return False, False
+    atuais = novos_parametros(configuracao)[:-1]
+    return certa, parametros[:-1] != atuais
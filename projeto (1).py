@@ -1,23 +1,168 @@
 import flask
 from flask import Flask, jsonify, request
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
+from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt, get_jwt_identity
+from werkzeug.serving import make_server
 import logging
 import psycopg2
-import hashlib
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import secrets
 import random
+import re
 import datetime
-
+import json
+import sys
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import csv
+import heapq
+import io
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+
+from consultas import Consultas
+from palavras_passe import gera_hash, confirma_hash
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Modo de execucao 'asgi' (opcional): servidor asyncio com o Flask numa pool de threads
+try:
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    uvicorn = None
+    WSGIMiddleware = None
 data_hoje = datetime.date.today()
 
 app = flask.Flask(__name__)
-app.config['JWT_SECRET_KEY'] = str(secrets.SystemRandom().getrandbits(128))
+# A chave tem de ser a mesma em todos os processos (e maquinas) que validam os tokens; sem JWT_SECRET_KEY
+# e gerada no arranque e so e partilhada pelos workers criados por fork deste processo
+app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY') or str(secrets.SystemRandom().getrandbits(128))
 jwt = JWTManager(app)
 
 StatusCodes = {
     'success': 200,
     'api_error': 400,
-    'internal_error': 500
+    'internal_error': 500,
+    'service_unavailable': 503
+}
+
+# 'table' (LOCK TABLE em todos os pedidos) ou 'row' (snapshots MVCC e bloqueios por linha)
+ConcurrencyMode = os.environ.get('DB_CONCURRENCY_MODE', 'row')
+
+# Ingestao de reproducoes: 'direct' (uma transacao por pedido) ou 'batched' (fila + escritor em lote)
+# Com ack 'sync' o pedido so responde depois de o lote ser gravado; com 'async' responde logo apos entrar na fila
+PlayIngestion = {
+    'mode': os.environ.get('PLAY_INGESTION_MODE', 'direct'),
+    'ack': os.environ.get('PLAY_INGESTION_ACK', 'sync'),
+    'queue_size': int(os.environ.get('PLAY_QUEUE_SIZE', 10000)),
+    'batch_size': int(os.environ.get('PLAY_BATCH_SIZE', 500)),
+    'flush_interval': float(os.environ.get('PLAY_FLUSH_INTERVAL', 0.2)),
+    'enqueue_timeout': float(os.environ.get('PLAY_ENQUEUE_TIMEOUT', 1)),
+    'ack_timeout': float(os.environ.get('PLAY_ACK_TIMEOUT', 5))
+}
+
+# Tamanho das paginas de /search_song (parametro ?limit=) e maximo de artistas/albuns por musica
+SearchPage = {
+    'default': int(os.environ.get('SEARCH_PAGE_DEFAULT', 50)),
+    'max': int(os.environ.get('SEARCH_PAGE_MAX', 500)),
+    'fanout': int(os.environ.get('SEARCH_MAX_ARTISTS_ALBUMS', 50))
+}
+
+# Tamanho das paginas de GET /comment (comentarios de topo por pagina, parametro ?limit=)
+CommentPage = {
+    'default': int(os.environ.get('COMMENT_PAGE_DEFAULT', 20)),
+    'max': int(os.environ.get('COMMENT_PAGE_MAX', 100))
+}
+
+# Caches de leitura: 'local' (LRU em memoria de cada processo) ou 'redis' (partilhada entre processos)
+CacheConfig = {
+    'backend': os.environ.get('CACHE_BACKEND', 'local'),
+    'redis_url': os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'),
+    'artist_ttl': float(os.environ.get('ARTIST_CACHE_TTL', 60)),
+    'artist_max': int(os.environ.get('ARTIST_CACHE_MAX', 10000)),
+    'plan_max': int(os.environ.get('PLAN_CACHE_MAX', 100000)),
+    'plan_max_ttl': float(os.environ.get('PLAN_CACHE_MAX_TTL', 3600)),
+    'plan_regular_ttl': float(os.environ.get('PLAN_CACHE_REGULAR_TTL', 30)),
+    'comment_ttl': float(os.environ.get('COMMENT_CACHE_TTL', 30)),
+    'comment_max': int(os.environ.get('COMMENT_CACHE_MAX', 10000)),
+    'login_ttl': float(os.environ.get('LOGIN_CACHE_TTL', 300)),
+    'login_max': int(os.environ.get('LOGIN_CACHE_MAX', 100000)),
+    'revoked_max': int(os.environ.get('REVOKED_TOKENS_MAX', 1000000))
+}
+
+# Pedidos de /card acima de stream_threshold cartoes sao gravados e enviados em lotes de batch cartoes
+CardGeneration = {
+    'batch': int(os.environ.get('CARD_BATCH_SIZE', 1000)),
+    'stream_threshold': int(os.environ.get('CARD_STREAM_THRESHOLD', 10000))
+}
+
+# Carregamento de catalogo (comando load_catalog): linhas por transacao
+CatalogLoad = {
+    'chunk': int(os.environ.get('CATALOG_CHUNK_SIZE', 10000))
+}
+
+# Criacao de contas em massa (comando provision_users): utilizadores por transacao
+UserProvisioning = {
+    'chunk': int(os.environ.get('PROVISION_CHUNK_SIZE', 5000))
+}
+
+# Hash das palavras-passe: algoritmo ('scrypt' ou 'pbkdf2_sha256') e custo de cada um; os hashes sao
+# calculados numa pool de workers threads, com no maximo queue_size pedidos a espera
+PasswordHashing = {
+    'algorithm': os.environ.get('PASSWORD_HASH_ALGORITHM', 'scrypt'),
+    'scrypt_n': int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14)),
+    'scrypt_r': int(os.environ.get('PASSWORD_SCRYPT_R', 8)),
+    'scrypt_p': int(os.environ.get('PASSWORD_SCRYPT_P', 1)),
+    'pbkdf2_iterations': int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', 600000)),
+    'workers': int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2)),
+    'queue_size': int(os.environ.get('PASSWORD_HASH_QUEUE', 64)),
+    'wait_timeout': float(os.environ.get('PASSWORD_HASH_WAIT_TIMEOUT', 10))
+}
+
+# Servidor HTTP: 'dev' (servidor do Werkzeug, uma thread por ligacao), 'asgi' (uvicorn; as ligacoes
+# paradas ou lentas ficam no event loop e so os pedidos em curso ocupam uma das asgi_threads threads)
+# ou 'prefork' (workers processos a aceitar ligacoes do mesmo socket, para usar varios cores; DB_POOL_MAX
+# e dividido pelos workers). Um worker que morre antes de worker_min_uptime segundos e recriado com uma
+# espera crescente, e o servidor desiste depois de worker_max_failures mortes seguidas
+ServerConfig = {
+    'mode': os.environ.get('SERVER_MODE', 'dev'),
+    'host': os.environ.get('SERVER_HOST', '127.0.0.1'),
+    'port': int(os.environ.get('SERVER_PORT', 8080)),
+    'asgi_threads': int(os.environ.get('ASGI_THREADS', os.environ.get('DB_POOL_MAX', 20))),
+    'keep_alive': int(os.environ.get('SERVER_KEEP_ALIVE', 75)),
+    'workers': int(os.environ.get('SERVER_WORKERS', os.cpu_count() or 1)),
+    'worker_min_uptime': float(os.environ.get('SERVER_WORKER_MIN_UPTIME', 10)),
+    'worker_max_failures': int(os.environ.get('SERVER_WORKER_MAX_FAILURES', 5))
+}
+
+# Instrucoes mais frequentes preparadas uma vez por ligacao (PREPARE/EXECUTE); 0 volta a enviar o SQL
+PreparedStatements = {
+    'enabled': os.environ.get('PREPARED_STATEMENTS', '1') != '0'
+}
+
+# /metrics: numero de duracoes recentes guardadas por rota para os percentis p50/p95/p99
+MetricsConfig = {
+    'samples': int(os.environ.get('METRICS_SAMPLES', 1024))
+}
+
+# Parametros da pool de ligacoes (podem ser alterados por variaveis de ambiente)
+PoolConfig = {
+    'min': int(os.environ.get('DB_POOL_MIN', 2)),
+    'max': int(os.environ.get('DB_POOL_MAX', 20)),
+    'wait_timeout': float(os.environ.get('DB_POOL_WAIT_TIMEOUT', 5)),
+    'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),
+    'check_after': float(os.environ.get('DB_POOL_CHECK_AFTER', 5))
 }
 
 
@@ -34,25 +179,300 @@ def ler_atributos_do_arquivo(nome_arquivo):
     return atributos
 
 
-def db_connection():
+def nova_ligacao():
     lista = ler_atributos_do_arquivo("config.txt")
     db = psycopg2.connect(
         user=lista[0],
         password=lista[1],
         host=lista[2],
         port=lista[3],
-        database=lista[4]
+        database=lista[4],
+        connection_factory=LigacaoPreparada,
+        cursor_factory=CursorCronometrado
     )
     return db
 
 
+# Tempos do pedido HTTP em curso nesta thread (preenchido entre before_request e after_request)
+pedido_atual = threading.local()
+
+
+class CursorCronometrado(psycopg2.extensions.cursor):
+    """Soma ao pedido em curso o tempo passado na base de dados e as linhas devolvidas."""
+
+    def _conta(self, inicio):
+        if getattr(pedido_atual, 'ativo', False):
+            pedido_atual.db += time.perf_counter() - inicio
+            pedido_atual.queries += 1
+            if self.description is not None and self.rowcount > 0:
+                pedido_atual.linhas += self.rowcount
+
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._conta(inicio)
+
+    def executemany(self, query, vars_list):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._conta(inicio)
+
+    def copy_expert(self, sql, file, size=8192):
+        inicio = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._conta(inicio)
+
+
+def conta_espera_lock(inicio):
+    if getattr(pedido_atual, 'ativo', False):
+        pedido_atual.lock += time.perf_counter() - inicio
+
+
+class LigacaoPreparada(psycopg2.extensions.connection):
+    """Ligacao que se lembra das instrucoes de `Consultas` ja preparadas na sua sessao."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+
+
+def executa_preparada(cur, nome, parametros):
+    tipos, sql = Consultas[nome]
+    if not PreparedStatements['enabled']:
+        # Mesmo SQL enviado e planeado a cada execucao, para comparar
+        cur.execute(re.sub(r'\$(\d+)', r'%(\1)s', sql),
+                    {str(i): valor for i, valor in enumerate(parametros, start=1)})
+        return
+
+    conn = cur.connection
+    if nome not in conn.preparadas:
+        cur.execute(f'PREPARE {nome} ({", ".join(tipos)}) AS {sql}')
+        conn.preparadas.add(nome)
+    cur.execute(f'EXECUTE {nome} ({", ".join(["%s"] * len(parametros))})', parametros)
+
+
+class ConnectionPool:
+    """Pool limitada de ligacoes, partilhada por todas as threads do servidor.
+
+    Quando todas as ligacoes estao ocupadas o pedido espera ate `wait_timeout`
+    segundos e depois falha com PoolError. Ligacoes paradas ha mais de
+    `check_after` segundos sao testadas antes de serem entregues e as que
+    excedem `max_idle` sao fechadas, mantendo sempre pelo menos `minconn`.
+    """
+
+    def __init__(self, minconn, maxconn, wait_timeout, max_idle, check_after):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.wait_timeout = wait_timeout
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._livres = collections.deque()  # (ligacao, instante da devolucao)
+        self._em_uso = 0
+        self._a_esperar = 0
+        self._cond = threading.Condition()
+        self._metricas = {
+            'opened': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'health_check_failures': 0,
+            'evicted': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0
+        }
+
+    def _total(self):
+        return len(self._livres) + self._em_uso
+
+    def _abre(self):
+        conn = nova_ligacao()
+        with self._cond:
+            self._metricas['opened'] += 1
+        return conn
+
+    def _fecha(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._metricas['closed'] += 1
+
+    def _expiradas(self):
+        # Chamado com o lock adquirido; as mais antigas estao a esquerda
+        agora = time.monotonic()
+        expiradas = []
+        while self._livres and self._total() > self.minconn and agora - self._livres[0][1] > self.max_idle:
+            expiradas.append(self._livres.popleft()[0])
+            self._metricas['evicted'] += 1
+        return expiradas
+
+    def _saudavel(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def preenche(self):
+        while True:
+            with self._cond:
+                if self._total() >= self.minconn:
+                    return
+                self._em_uso += 1
+            try:
+                conn = self._abre()
+            except Exception:
+                with self._cond:
+                    self._em_uso -= 1
+                    self._cond.notify()
+                raise
+            self.putconn(conn)
+
+    def getconn(self):
+        inicio = time.monotonic()
+        limite = inicio + self.wait_timeout
+        conn = None
+        devolvida = None
+        esperou = False
+        expiradas = []
+
+        try:
+            with self._cond:
+                while True:
+                    expiradas += self._expiradas()
+                    if self._livres:
+                        # LIFO: reutiliza as ligacoes mais recentes e deixa as restantes envelhecer
+                        conn, devolvida = self._livres.pop()
+                        self._em_uso += 1
+                        break
+                    if self._total() < self.maxconn:
+                        self._em_uso += 1
+                        break
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._metricas['timeouts'] += 1
+                        raise psycopg2.pool.PoolError(f'no database connection available after {self.wait_timeout}s')
+                    if not esperou:
+                        esperou = True
+                        self._metricas['waits'] += 1
+                    self._a_esperar += 1
+                    self._cond.wait(restante)
+                    self._a_esperar -= 1
+
+                espera = time.monotonic() - inicio
+                self._metricas['checkouts'] += 1
+                self._metricas['wait_time_total'] += espera
+                self._metricas['wait_time_max'] = max(self._metricas['wait_time_max'], espera)
+        finally:
+            for velha in expiradas:
+                self._fecha(velha)
+
+        try:
+            if conn is None:
+                conn = self._abre()
+            elif time.monotonic() - devolvida >= self.check_after and not self._saudavel(conn):
+                with self._cond:
+                    self._metricas['health_check_failures'] += 1
+                self._fecha(conn)
+                conn = self._abre()
+        except Exception:
+            with self._cond:
+                self._em_uso -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn):
+        # Uma ligacao so volta para a pool sem transacao aberta
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+
+        descartar = conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        if descartar:
+            self._fecha(conn)
+
+        with self._cond:
+            self._em_uso -= 1
+            if not descartar:
+                self._livres.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            estado = dict(self._metricas)
+            estado['size'] = self._total()
+            estado['in_use'] = self._em_uso
+            estado['idle'] = len(self._livres)
+            estado['waiting'] = self._a_esperar
+            estado['max'] = self.maxconn
+            estado['saturation'] = self._em_uso / self.maxconn
+            estado['wait_time_avg'] = estado['wait_time_total'] / estado['checkouts'] if estado['checkouts'] else 0.0
+        return estado
+
+
+pool = ConnectionPool(PoolConfig['min'], PoolConfig['max'], PoolConfig['wait_timeout'],
+                      PoolConfig['max_idle'], PoolConfig['check_after'])
+
+
+def db_connection():
+    return pool.getconn()
+
+
+def db_release(conn):
+    pool.putconn(conn)
+
+
+def inicia_transacao(cur, tabelas, so_leitura=False):
+    # Modo 'table': cada pedido bloqueia as tabelas que usa (serializa a API)
+    # Modo 'row': leituras usam um snapshot MVCC e escritas bloqueiam apenas as linhas necessarias
+    if ConcurrencyMode == 'table':
+        cur.execute('BEGIN')
+        inicio = time.perf_counter()
+        cur.execute(f'LOCK TABLE {tabelas} IN EXCLUSIVE MODE')
+        conta_espera_lock(inicio)
+    elif so_leitura:
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+
+
+def bloqueia_consumidor(cur, consumidor_id):
+    # Serializa as escritas de um mesmo consumidor sem bloquear as restantes
+    if ConcurrencyMode == 'row':
+        inicio = time.perf_counter()
+        executa_preparada(cur, 'bloqueia_consumidor', (consumidor_id,))
+        conta_espera_lock(inicio)
+
+
 def ponto_virgula_recursivo(rec):
+    # 1 se algum texto, tambem dentro de listas e objetos, tem ";". Numeros, booleanos e null nao tem
     if isinstance(rec, list):
         for i in rec:
-            ponto_virgula_recursivo(i)
-    else:
+            if ponto_virgula_recursivo(i) == 1:
+                return 1
+    elif isinstance(rec, dict):
+        for i in rec.values():
+            if ponto_virgula_recursivo(i) == 1:
+                return 1
+    elif isinstance(rec, str):
         if ";" in rec:
             return 1
+    return 0
 
 
 def check_payload(payload):
@@ -62,6 +482,766 @@ def check_payload(payload):
     return 0
 
 
+##########################################################
+## CACHE
+##########################################################
+
+class LocalCache:
+    """Cache LRU em memoria com expiracao por entrada, partilhada pelas threads do processo."""
+
+    def __init__(self, nome, max_entries, ttl):
+        self.nome = nome
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._dados = collections.OrderedDict()  # chave -> (instante de expiracao, valor)
+        self._lock = threading.Lock()
+        self._metricas = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, chave):
+        with self._lock:
+            entrada = self._dados.get(chave)
+            if entrada is None:
+                self._metricas['misses'] += 1
+                return None
+            if entrada[0] <= time.monotonic():
+                del self._dados[chave]
+                self._metricas['expirations'] += 1
+                self._metricas['misses'] += 1
+                return None
+            self._dados.move_to_end(chave)
+            self._metricas['hits'] += 1
+            return entrada[1]
+
+    def set(self, chave, valor, ttl=None):
+        expira = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._dados[chave] = (expira, valor)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.max_entries:
+                self._dados.popitem(last=False)
+                self._metricas['evictions'] += 1
+
+    def delete(self, chave):
+        with self._lock:
+            self._metricas['invalidations'] += 1
+            self._dados.pop(chave, None)
+
+    def stats(self):
+        with self._lock:
+            estado = dict(self._metricas)
+            estado['entries'] = len(self._dados)
+        return estado
+
+
+class RedisCache:
+    """Mesma interface que LocalCache, guardada num Redis partilhado por todos os processos.
+
+    A expiracao e a remocao das entradas menos usadas ficam a cargo do Redis
+    (maxmemory-policy), por isso as evictions nao sao contadas aqui.
+    """
+
+    def __init__(self, nome, ttl, url):
+        self.nome = nome
+        self.ttl = ttl
+        self._cliente = redis.Redis.from_url(url)
+        self._lock = threading.Lock()
+        self._metricas = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def _chave(self, chave):
+        return f'{self.nome}:{chave}'
+
+    def get(self, chave):
+        valor = self._cliente.get(self._chave(chave))
+        with self._lock:
+            self._metricas['hits' if valor is not None else 'misses'] += 1
+        return json.loads(valor) if valor is not None else None
+
+    def set(self, chave, valor, ttl=None):
+        self._cliente.set(self._chave(chave), json.dumps(valor), px=int((self.ttl if ttl is None else ttl) * 1000))
+        return True
+
+    def delete(self, chave):
+        with self._lock:
+            self._metricas['invalidations'] += 1
+        self._cliente.delete(self._chave(chave))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._metricas)
+
+
+def cria_cache(nome, max_entries, ttl):
+    if CacheConfig['backend'] == 'redis':
+        if redis is None:
+            raise RuntimeError('CACHE_BACKEND=redis requires the redis package')
+        return RedisCache(nome, ttl, CacheConfig['redis_url'])
+    return LocalCache(nome, max_entries, ttl)
+
+
+# Resultado de /artist_info por id de artista
+cache_artistas = cria_cache('artist_info', CacheConfig['artist_max'], CacheConfig['artist_ttl'])
+
+
+# Data de validade do plano atual de cada consumidor
+cache_planos = cria_cache('plan', CacheConfig['plan_max'], CacheConfig['plan_max_ttl'])
+
+
+# Primeira pagina de GET /comment (com o tamanho por omissao) por ismn
+cache_comentarios = cria_cache('comments', CacheConfig['comment_max'], CacheConfig['comment_ttl'])
+
+
+# Id e tipo de cada utilizador, por username (para o /login). O hash da palavra-passe nunca fica em cache
+cache_logins = cria_cache('login', CacheConfig['login_max'], CacheConfig['login_ttl'])
+
+
+def invalida_artistas(ids_artistas):
+    for artista_id in set(int(artista_id) for artista_id in ids_artistas):
+        cache_artistas.delete(artista_id)
+
+
+##########################################################
+## PLAY INGESTION
+##########################################################
+
+class ReproducaoPendente:
+    """Permite a um pedido com ack sincrono esperar que o seu lote seja gravado."""
+
+    def __init__(self):
+        self.gravada = threading.Event()
+        self.erro = None
+
+
+class PlayIngestor:
+    """Fila limitada de reproducoes gravadas em lote por uma thread de fundo.
+
+    As musicas sao validadas contra um conjunto em memoria dos ISMN conhecidos
+    e o escritor junta ate `batch_size` reproducoes (ou o que chegar em
+    `flush_interval` segundos) num unico INSERT com varias linhas.
+    """
+
+    def __init__(self, queue_size, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fila = queue.Queue(maxsize=queue_size)
+        self._ismns = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._parar = threading.Event()
+        self._metricas = {
+            'enqueued': 0,
+            'rejected': 0,
+            'batches': 0,
+            'rows_written': 0,
+            'rows_failed': 0,
+            'flush_time_total': 0.0
+        }
+
+    def _carrega_ismns(self):
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT ismn FROM musica')
+            ismns = {linha[0] for linha in cur.fetchall()}
+            conn.commit()
+        finally:
+            db_release(conn)
+        return ismns
+
+    def conhece(self, ismn):
+        if self._ismns is None:
+            ismns = self._carrega_ismns()
+            with self._lock:
+                if self._ismns is None:
+                    self._ismns = ismns
+        if ismn in self._ismns:
+            return True
+
+        # Musica criada por outro processo depois de o conjunto ter sido carregado
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            executa_preparada(cur, 'musica_existe', (ismn,))
+            existe = cur.fetchone() is not None
+            conn.commit()
+        finally:
+            db_release(conn)
+        if existe:
+            self.regista_musicas([ismn])
+        return existe
+
+    def regista_musicas(self, ismns):
+        with self._lock:
+            if self._ismns is not None:
+                self._ismns.update(int(ismn) for ismn in ismns)
+
+    def _arranca(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._parar.clear()
+                self._thread = threading.Thread(target=self._escritor, name='play-ingestor', daemon=True)
+                self._thread.start()
+
+    def submete(self, data, consumidor_id, ismn, sincrono):
+        self._arranca()
+        pendente = ReproducaoPendente() if sincrono else None
+        try:
+            self.fila.put((data, consumidor_id, ismn, pendente), timeout=PlayIngestion['enqueue_timeout'])
+        except queue.Full:
+            with self._lock:
+                self._metricas['rejected'] += 1
+            raise
+        with self._lock:
+            self._metricas['enqueued'] += 1
+        return pendente
+
+    def _escritor(self):
+        while True:
+            try:
+                primeiro = self.fila.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self._parar.is_set():
+                    return
+                continue
+
+            lote = [primeiro]
+            limite = time.monotonic() + self.flush_interval
+            while len(lote) < self.batch_size:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self.fila.get(timeout=restante))
+                except queue.Empty:
+                    break
+            self._grava(lote)
+
+    def _insere(self, conn, lote):
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(
+            cur,
+            'INSERT INTO contagem_musica (data,consumidor_utilizador_id,musica_ismn) VALUES %s',
+            [linha[:3] for linha in lote],
+            page_size=len(lote))
+        conn.commit()
+
+    def _desfaz(self, conn):
+        # Falso se a ligacao ja nao serve (por exemplo depois de a base de dados reiniciar)
+        if conn.closed:
+            return False
+        try:
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _grava(self, lote):
+        inicio = time.monotonic()
+        escritas = set()  # posicoes no lote das linhas ja gravadas
+        falhadas = []
+        try:
+            conn = db_connection()
+            try:
+                self._insere(conn, lote)
+                escritas.update(range(len(lote)))
+            except (psycopg2.InterfaceError, psycopg2.OperationalError) as error:
+                # Erro da ligacao e nao dos dados: repetir linha a linha na mesma ligacao nao adianta
+                falhadas = [(linha, error) for linha in lote]
+            except psycopg2.Error as error:
+                if not self._desfaz(conn):
+                    falhadas = [(linha, error) for linha in lote]
+                else:
+                    logger.error(f'play ingestion - batch of {len(lote)} failed, retrying row by row: {error}')
+                    # Isola as linhas invalidas para nao perder o resto do lote
+                    for posicao, linha in enumerate(lote):
+                        try:
+                            self._insere(conn, [linha])
+                            escritas.add(posicao)
+                        except psycopg2.Error as erro_linha:
+                            falhadas.append((linha, erro_linha))
+                            if not self._desfaz(conn):
+                                falhadas += [(resto, erro_linha) for resto in lote[posicao + 1:]]
+                                break
+            finally:
+                db_release(conn)
+        except Exception as error:
+            logger.error(f'play ingestion - error: {error}')
+            falhadas = [(linha, error) for posicao, linha in enumerate(lote) if posicao not in escritas]
+        finally:
+            # Quem espera pelo lote e sempre avisado, e a thread do escritor nunca termina por um erro
+            for linha, error in falhadas:
+                logger.error(f'play ingestion - dropped play {linha[:3]}: {error}')
+                if linha[3] is not None:
+                    linha[3].erro = str(error)
+
+            for linha in lote:
+                if linha[3] is not None:
+                    linha[3].gravada.set()
+
+            with self._lock:
+                self._metricas['batches'] += 1
+                self._metricas['rows_written'] += len(lote) - len(falhadas)
+                self._metricas['rows_failed'] += len(falhadas)
+                self._metricas['flush_time_total'] += time.monotonic() - inicio
+
+    def termina(self):
+        # Grava o que ainda estiver na fila antes de o processo terminar
+        self._parar.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(PlayIngestion['ack_timeout'], self.flush_interval * 2))
+            if self._thread.is_alive() or not self.fila.empty():
+                logger.warning(f'play ingestion - shutting down before the queue was flushed: '
+                               f'{self.fila.qsize()} queued plays will not be saved')
+
+    def stats(self):
+        with self._lock:
+            estado = dict(self._metricas)
+        estado['queued'] = self.fila.qsize()
+        estado['queue_size'] = self.fila.maxsize
+        estado['known_songs'] = len(self._ismns) if self._ismns is not None else 0
+        return estado
+
+
+ingestor = PlayIngestor(PlayIngestion['queue_size'], PlayIngestion['batch_size'], PlayIngestion['flush_interval'])
+atexit.register(lambda: ingestor.termina())
+
+
+def regista_reproducao_em_lote(song, consumidor_id):
+    try:
+        ismn = int(song)
+    except ValueError:
+        return {'status': StatusCodes['api_error'], 'results': 'Given song does not exist'}
+
+    if not ingestor.conhece(ismn):
+        return {'status': StatusCodes['api_error'], 'results': 'Given song does not exist'}
+
+    try:
+        pendente = ingestor.submete(data_hoje, consumidor_id, ismn, PlayIngestion['ack'] == 'sync')
+    except queue.Full:
+        return {'status': StatusCodes['service_unavailable'], 'errors': 'Too many plays queued, try again later'}
+
+    if pendente is not None:
+        if not pendente.gravada.wait(PlayIngestion['ack_timeout']):
+            return {'status': StatusCodes['service_unavailable'], 'errors': 'Timed out waiting for the play to be saved'}
+        if pendente.erro is not None:
+            return {'status': StatusCodes['internal_error'], 'errors': pendente.erro}
+
+    return {'status': StatusCodes['success'], 'results': "sucess"}
+
+
+##########################################################
+## PASSWORDS
+##########################################################
+
+class PasswordHasher:
+    """Calcula os hashes numa pool limitada de threads.
+
+    O scrypt e o PBKDF2 do hashlib libertam o GIL, por isso as threads usam varios cores sem
+    bloquear as threads dos pedidos mais do que o tempo do proprio hash. Quando ja ha queue_size
+    hashes a espera, submete lanca queue.Full e o pedido responde 503; em_fundo nao espera e
+    simplesmente nao corre.
+    """
+
+    def __init__(self, workers, queue_size, wait_timeout):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._vagas = threading.BoundedSemaphore(workers + queue_size)
+        self._wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._contadores = {'workers': workers, 'hashes': 0, 'rejected': 0, 'rehashed': 0, 'rehash_skipped': 0,
+                            'busy_seconds': 0.0}
+
+    def _corre(self, funcao, *argumentos):
+        inicio = time.perf_counter()
+        try:
+            return funcao(*argumentos)
+        finally:
+            with self._lock:
+                self._contadores['hashes'] += 1
+                self._contadores['busy_seconds'] += time.perf_counter() - inicio
+
+    def submete(self, funcao, *argumentos):
+        if not self._vagas.acquire(timeout=self._wait_timeout):
+            with self._lock:
+                self._contadores['rejected'] += 1
+            raise queue.Full
+        try:
+            return self._executor.submit(self._corre, funcao, *argumentos).result()
+        finally:
+            self._vagas.release()
+
+    def em_fundo(self, funcao, *argumentos):
+        # Corre funcao numa thread da pool sem esperar pelo resultado; se a pool esta cheia nao corre
+        if not self._vagas.acquire(blocking=False):
+            with self._lock:
+                self._contadores['rehash_skipped'] += 1
+            return False
+        tarefa = self._executor.submit(self._corre, funcao, *argumentos)
+        tarefa.add_done_callback(lambda resultado: self._vagas.release())
+        return True
+
+    def gera(self, palavra_passe):
+        return self.submete(gera_hash, palavra_passe, PasswordHashing)
+
+    def gera_varios(self, palavras_passe):
+        # Para os comandos: usa todos os workers sem passar pelo limite de pedidos a espera
+        return list(self._executor.map(self._corre, [gera_hash] * len(palavras_passe), palavras_passe,
+                                       [PasswordHashing] * len(palavras_passe)))
+
+    def confirma(self, palavra_passe, guardado):
+        return self.submete(confirma_hash, palavra_passe, guardado, PasswordHashing)
+
+    def conta_rehash(self):
+        with self._lock:
+            self._contadores['rehashed'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._contadores)
+
+
+hasher = PasswordHasher(PasswordHashing['workers'], PasswordHashing['queue_size'], PasswordHashing['wait_timeout'])
+
+
+##########################################################
+## AUTHENTICATION
+##########################################################
+
+# Os tokens so levam o id (sub) e o tipo (role) do utilizador, e cada pedido e autorizado sem ir a base
+# de dados. Um token deixa de valer quando o seu jti esta na lista de revogados (logout) ou quando foi
+# emitido antes da revogacao de todos os tokens do utilizador (por exemplo depois de mudar de tipo).
+# As entradas so saem quando os tokens a que se referem expirariam: nunca sao descartadas para dar
+# lugar a outras, porque isso voltaria a aceitar tokens revogados
+
+class ListaRevogacoes:
+    """Lista de revogacoes em memoria cujas entradas so saem quando expiram.
+
+    Ao contrario de LocalCache nao descarta as entradas mais antigas quando esta cheia: com max_entries
+    revogacoes por expirar, set recusa a nova e devolve False.
+    """
+
+    def __init__(self, nome, max_entries):
+        self.nome = nome
+        self.max_entries = max_entries
+        self._dados = {}  # chave -> (instante de expiracao, valor)
+        self._expiracoes = []  # heap de (instante de expiracao, chave), a mais proxima primeiro
+        self._lock = threading.Lock()
+        self._metricas = {'hits': 0, 'misses': 0, 'expirations': 0, 'rejected': 0}
+
+    def _limpa(self, agora):
+        # Chamado com o lock adquirido. Uma chave revogada de novo deixa no heap a expiracao antiga,
+        # que e ignorada aqui; o heap e reconstruido se essas entradas se acumularem
+        while self._expiracoes and self._expiracoes[0][0] <= agora:
+            expira, chave = heapq.heappop(self._expiracoes)
+            entrada = self._dados.get(chave)
+            if entrada is not None and entrada[0] == expira:
+                del self._dados[chave]
+                self._metricas['expirations'] += 1
+        if len(self._expiracoes) > 2 * len(self._dados) + 1024:
+            self._expiracoes = [(expira, chave) for chave, (expira, valor) in self._dados.items()]
+            heapq.heapify(self._expiracoes)
+
+    def get(self, chave):
+        with self._lock:
+            entrada = self._dados.get(chave)
+            if entrada is None or entrada[0] <= time.monotonic():
+                self._metricas['misses'] += 1
+                return None
+            self._metricas['hits'] += 1
+            return entrada[1]
+
+    def set(self, chave, valor, ttl):
+        agora = time.monotonic()
+        with self._lock:
+            self._limpa(agora)
+            if chave not in self._dados and len(self._dados) >= self.max_entries:
+                self._metricas['rejected'] += 1
+                return False
+            self._dados[chave] = (agora + ttl, valor)
+            heapq.heappush(self._expiracoes, (agora + ttl, chave))
+            return True
+
+    def stats(self):
+        with self._lock:
+            estado = dict(self._metricas)
+            estado['entries'] = len(self._dados)
+        return estado
+
+
+def cria_lista_revogacoes(nome):
+    # Com CACHE_BACKEND=redis as listas sao partilhadas por todos os processos. O Redis tem de usar
+    # maxmemory-policy noeviction, para as chaves so sairem por expiracao e uma escrita com a memoria
+    # cheia falhar em vez de apagar outra revogacao
+    if CacheConfig['backend'] == 'redis':
+        return cria_cache(nome, CacheConfig['revoked_max'], 60)
+    return ListaRevogacoes(nome, CacheConfig['revoked_max'])
+
+
+tokens_revogados = cria_lista_revogacoes('revoked_tokens')
+utilizadores_revogados = cria_lista_revogacoes('revoked_users')
+
+
+def duracao_token():
+    # Segundos de validade de um access token (JWT_ACCESS_TOKEN_EXPIRES=False: sem expiracao)
+    duracao = app.config['JWT_ACCESS_TOKEN_EXPIRES']
+    if isinstance(duracao, datetime.timedelta):
+        return duracao.total_seconds()
+    return 365 * 24 * 3600
+
+
+def cria_token(id_utilizador, tipo):
+    # O iat tem segundos inteiros e um token emitido no segundo de uma revogacao do utilizador seria
+    # recusado: nesse caso o token so e emitido no segundo seguinte
+    revogado_em = utilizadores_revogados.get(str(id_utilizador))
+    if revogado_em is not None:
+        espera = revogado_em + 1 - time.time()
+        if espera > 0:
+            time.sleep(espera)
+    return create_access_token(identity=str(id_utilizador), additional_claims={'role': tipo})
+
+
+def utilizador_atual():
+    # {'id': ..., 'type': ...} do token do pedido, ou None num pedido sem token (jwt_required(optional=True))
+    identidade = get_jwt_identity()
+    if identidade is None:
+        return None
+    return {'id': int(identidade), 'type': get_jwt().get('role')}
+
+
+def revoga_utilizador(id_utilizador):
+    # Todos os tokens do utilizador emitidos ate agora, incluindo os deste segundo, deixam de ser aceites.
+    # Devolve False se a lista esta cheia e a revogacao nao foi registada
+    guardada = utilizadores_revogados.set(str(id_utilizador), int(time.time()), ttl=duracao_token())
+    if not guardada:
+        logger.error(f'revoked users list is full ({CacheConfig["revoked_max"]} entries), user {id_utilizador} not revoked')
+    return guardada
+
+
+@jwt.token_in_blocklist_loader
+def token_revogado(jwt_header, jwt_payload):
+    if tokens_revogados.get(jwt_payload['jti']) is not None:
+        return True
+    revogado_em = utilizadores_revogados.get(jwt_payload['sub'])
+    return revogado_em is not None and jwt_payload['iat'] <= revogado_em
+
+
+##########################################################
+## METRICS
+##########################################################
+
+def etiqueta(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metricas:
+    """Duracao, tempo na base de dados, espera por locks e linhas de cada rota, em formato Prometheus.
+
+    Cada pedido custa uma aquisicao de lock e algumas somas; o histograma usa baldes fixos e os
+    percentis sao calculados so quando /metrics e pedido, a partir das ultimas `amostras` duracoes.
+    """
+
+    BALDES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, amostras):
+        self._amostras = amostras
+        self._lock = threading.Lock()
+        self._rotas = {}  # (metodo, rota) -> contadores
+
+    def regista(self, metodo, rota, codigo, duracao, db, lock, linhas, queries):
+        with self._lock:
+            r = self._rotas.get((metodo, rota))
+            if r is None:
+                r = self._rotas[(metodo, rota)] = {
+                    'baldes': [0] * len(self.BALDES), 'count': 0, 'sum': 0.0, 'db': 0.0, 'python': 0.0,
+                    'lock': 0.0, 'rows': 0, 'queries': 0, 'codes': collections.Counter(),
+                    'recentes': collections.deque(maxlen=self._amostras)}
+            indice = bisect.bisect_left(self.BALDES, duracao)
+            if indice < len(self.BALDES):
+                r['baldes'][indice] += 1
+            r['count'] += 1
+            r['sum'] += duracao
+            r['db'] += db
+            r['python'] += max(duracao - db, 0.0)
+            r['lock'] += lock
+            r['rows'] += linhas
+            r['queries'] += queries
+            r['codes'][codigo] += 1
+            r['recentes'].append(duracao)
+
+    def texto(self):
+        with self._lock:
+            rotas = {chave: dict(r, baldes=list(r['baldes']), codes=dict(r['codes']), recentes=list(r['recentes']))
+                     for chave, r in self._rotas.items()}
+
+        linhas = []
+
+        def metrica(nome, tipo, ajuda):
+            linhas.append(f'# HELP {nome} {ajuda}')
+            linhas.append(f'# TYPE {nome} {tipo}')
+
+        metrica('api_request_duration_seconds', 'histogram', 'Request duration per route.')
+        for (metodo, rota), r in sorted(rotas.items()):
+            rotulo = f'method="{etiqueta(metodo)}",route="{etiqueta(rota)}"'
+            acumulado = 0
+            for limite, quantidade in zip(self.BALDES, r['baldes']):
+                acumulado += quantidade
+                linhas.append(f'api_request_duration_seconds_bucket{{{rotulo},le="{limite}"}} {acumulado}')
+            linhas.append(f'api_request_duration_seconds_bucket{{{rotulo},le="+Inf"}} {r["count"]}')
+            linhas.append(f'api_request_duration_seconds_sum{{{rotulo}}} {r["sum"]}')
+            linhas.append(f'api_request_duration_seconds_count{{{rotulo}}} {r["count"]}')
+
+        metrica('api_request_latency_seconds', 'summary', 'Percentiles of the most recent request durations per route.')
+        for (metodo, rota), r in sorted(rotas.items()):
+            rotulo = f'method="{etiqueta(metodo)}",route="{etiqueta(rota)}"'
+            recentes = sorted(r['recentes'])
+            for q in (0.5, 0.95, 0.99):
+                valor = recentes[min(len(recentes) - 1, int(q * len(recentes)))]
+                linhas.append(f'api_request_latency_seconds{{{rotulo},quantile="{q}"}} {valor}')
+            linhas.append(f'api_request_latency_seconds_sum{{{rotulo}}} {r["sum"]}')
+            linhas.append(f'api_request_latency_seconds_count{{{rotulo}}} {r["count"]}')
+
+        for nome, chave, ajuda in (
+                ('api_request_db_seconds_total', 'db', 'Time spent in database calls.'),
+                ('api_request_python_seconds_total', 'python', 'Request time outside database calls.'),
+                ('api_lock_wait_seconds_total', 'lock', 'Time spent waiting for table or row locks.'),
+                ('api_db_rows_returned_total', 'rows', 'Rows returned by queries.'),
+                ('api_db_queries_total', 'queries', 'Statements executed.')):
+            metrica(nome, 'counter', ajuda)
+            for (metodo, rota), r in sorted(rotas.items()):
+                linhas.append(f'{nome}{{method="{etiqueta(metodo)}",route="{etiqueta(rota)}"}} {r[chave]}')
+
+        metrica('api_responses_total', 'counter', 'Responses per route and HTTP status.')
+        for (metodo, rota), r in sorted(rotas.items()):
+            for codigo, quantidade in sorted(r['codes'].items()):
+                linhas.append(f'api_responses_total{{method="{etiqueta(metodo)}",route="{etiqueta(rota)}",'
+                              f'code="{codigo}"}} {quantidade}')
+
+        estado = pool.stats()
+        for nome, tipo, valor, ajuda in (
+                ('api_db_connections_opened_total', 'counter', estado['opened'], 'Database connections opened.'),
+                ('api_db_connections_closed_total', 'counter', estado['closed'], 'Database connections closed.'),
+                ('api_db_pool_wait_seconds_total', 'counter', estado['wait_time_total'],
+                 'Time requests waited for a pooled connection.'),
+                ('api_db_pool_timeouts_total', 'counter', estado['timeouts'], 'Requests that got no connection.'),
+                ('api_db_pool_in_use', 'gauge', estado['in_use'], 'Connections lent to requests.'),
+                ('api_db_pool_idle', 'gauge', estado['idle'], 'Idle connections in the pool.'),
+                ('api_db_pool_waiting', 'gauge', estado['waiting'], 'Requests waiting for a connection.')):
+            metrica(nome, tipo, ajuda)
+            linhas.append(f'{nome} {valor}')
+
+        return '\n'.join(linhas) + '\n'
+
+
+metricas = Metricas(MetricsConfig['samples'])
+
+
+@app.before_request
+def inicia_metricas():
+    pedido_atual.ativo = True
+    pedido_atual.inicio = time.perf_counter()
+    pedido_atual.db = 0.0
+    pedido_atual.lock = 0.0
+    pedido_atual.linhas = 0
+    pedido_atual.queries = 0
+
+
+@app.after_request
+def regista_metricas(response):
+    if getattr(pedido_atual, 'ativo', False):
+        pedido_atual.ativo = False
+        # A rota (por exemplo /comment/<song_id>) e nao o caminho, para o numero de series ser limitado
+        rota = flask.request.url_rule.rule if flask.request.url_rule is not None else '<unmatched>'
+        metricas.regista(flask.request.method, rota, response.status_code, time.perf_counter() - pedido_atual.inicio,
+                         pedido_atual.db, pedido_atual.lock, pedido_atual.linhas, pedido_atual.queries)
+    return response
+
+
+@app.teardown_request
+def termina_metricas(error):
+    # Um pedido que termina com excecao nao passa pelo after_request
+    pedido_atual.ativo = False
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return flask.Response(metricas.texto(), mimetype='text/plain; version=0.0.4')
+
+
+##########################################################
+## ENDPOINTS
+##########################################################
+
+@app.errorhandler(psycopg2.pool.PoolError)
+def pool_esgotada(error):
+    logger.error(f'{flask.request.method} {flask.request.path} - error: {error}')
+    response = {'status': StatusCodes['service_unavailable'], 'errors': str(error)}
+    return flask.jsonify(response)
+
+
+@app.route('/stats', methods=['GET'])
+@jwt_required()
+def stats():
+    user_payload = utilizador_atual()
+    if (user_payload['type'] == "administrador"):
+        logger.info('GET /stats')
+        response = {'status': StatusCodes['success'],
+                    'results': {'pool': pool.stats(), 'ingestion': ingestor.stats(),
+                                'artist_cache': cache_artistas.stats(), 'plan_cache': cache_planos.stats(),
+                                'comment_cache': cache_comentarios.stats(), 'login_cache': cache_logins.stats(),
+                                'password_hashing': hasher.stats(), 'revoked_tokens': tokens_revogados.stats()}}
+    else:
+        response = {'status': StatusCodes['api_error'], 'results': 'Only admins can see the server stats'}
+    return flask.jsonify(response)
+
+
+def consulta_relatorio(cur, inicio, fim):
+    # Lê o agregado mensal mantido pelo trigger em contagem_musica (meses de inicio a fim, inclusive)
+    cur.execute('''
+        SELECT
+            to_char(mes, 'YYYY-MM') AS date,
+            NULLIF(genero, '') AS genre,
+            SUM(reproducoes)::BIGINT AS playbacks
+        FROM
+            reproducoes_mes_genero
+        WHERE
+            mes BETWEEN %s AND %s
+        GROUP BY
+            mes, genero
+        ORDER BY
+            date, playbacks DESC
+    ''', (inicio, fim))
+    return cur.fetchall()
+
+
+def consulta_relatorio_bruto(cur, inicio, fim):
+    # Mesma consulta calculada diretamente sobre contagem_musica (usada para verificar o agregado)
+    cur.execute('''
+        SELECT
+            to_char(cm.data, 'YYYY-MM') AS date,
+            m.genero AS genre,
+            COUNT(*) AS playbacks
+        FROM
+            contagem_musica cm
+        INNER JOIN
+            musica m ON cm.musica_ismn = m.ismn
+        WHERE
+            cm.data >= %s AND cm.data < (%s::DATE + INTERVAL '1 month')
+        GROUP BY
+            date, genre
+        ORDER BY
+            date, playbacks DESC
+    ''', (inicio, fim))
+    return cur.fetchall()
+
+
+def janela_relatorio(year_month):
+    # Os 12 meses do relatorio: de 11 meses antes de year_month ('YYYY-MM') ate year_month, inclusive,
+    # para o mesmo mes nao aparecer duas vezes (a resposta so indica o mes)
+    year = int(year_month.split('-')[0])
+    month = int(year_month.split('-')[1])
+    fim = datetime.date(year, month, 1)
+    inicio = datetime.date(year, 1, 1) if month == 12 else datetime.date(year - 1, month + 1, 1)
+    return inicio, fim
+
+
 @app.route('/report/<year_month>', methods=['GET'])
 @jwt_required()
 def generate_monthly_report(year_month):
@@ -75,37 +1255,13 @@ def generate_monthly_report(year_month):
     cur = conn.cursor()
 
     try:
-        cur.execute('BEGIN')
-        cur.execute('LOCK TABLE contagem_musica,musica IN EXCLUSIVE MODE')
+        inicia_transacao(cur, 'reproducoes_mes_genero', so_leitura=True)
         # recebe dois parâmetros: N (número de resultados desejados) e year_month (ano e mês no formato 'YYYY-MM'). CUIDADO PROTEGER!!!!!!!!!
-        # Extrair o ano e mês da string year_month
-        year = int(year_month.split('-')[0])
-        month = int(year_month.split('-')[1])
-
         # Calcular a data inicial e final do período de 12 meses
-        start_date = datetime.date(year, month, 1)
-        end_date = datetime.date(year - 1, month, 1)
+        end_date, start_date = janela_relatorio(year_month)
 
-        # Consulta para obter o número de músicas reproduzidas por mês e genero
-        query = f'''
-            SELECT
-                to_char(cm.data, 'YYYY-MM') AS date,
-                m.genero AS genre,
-                COUNT(*) AS playbacks
-            FROM
-                contagem_musica cm
-            INNER JOIN
-                musica m ON cm.musica_ismn = m.ismn
-            WHERE
-                cm.data BETWEEN '{end_date}' AND '{start_date}'
-            GROUP BY
-                date, genre
-            ORDER BY
-                date, playbacks DESC
-                ;
-        '''
-        cur.execute(query)
-        rows = cur.fetchall()
+        # Número de músicas reproduzidas por mês e genero, lido do agregado mensal
+        rows = consulta_relatorio(cur, end_date, start_date)
         print(rows)
 
         # Formatar os resultados
@@ -129,7 +1285,7 @@ def generate_monthly_report(year_month):
 
     finally:
         if conn is not None:
-            conn.close()
+            db_release(conn)
 
     return flask.jsonify(response)
 
@@ -142,28 +1298,50 @@ def detail_artist(artist_id):
         response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
         return flask.jsonify(response)
 
+    try:
+        artist_id = int(artist_id)
+    except ValueError:
+        response = {'status': StatusCodes['api_error'], 'results': 'Given artist id is not valid'}
+        return flask.jsonify(response)
+
+    artist_info = cache_artistas.get(artist_id)
+    if artist_info is not None:
+        response = {'status': StatusCodes['success'], 'results': artist_info}
+        return flask.jsonify(response)
+
     conn = db_connection()
     cur = conn.cursor()
 
     try:
-        cur.execute('BEGIN')
-        cur.execute('LOCK TABLE artista,musica,album IN EXCLUSIVE MODE')
+        inicia_transacao(cur, 'artista,musica,album', so_leitura=True)
         # Consulta para obter as informações do artista
+        # Cada lista é agregada numa subconsulta própria, para as músicas, álbuns e playlists
+        # não se multiplicarem entre si antes de agrupar
         query = """
         SELECT
             a.nome AS nome,
-            ARRAY_AGG(DISTINCT m.ismn) AS musicas,
-            ARRAY_AGG(DISTINCT al.id) AS albums,
-            ARRAY_AGG(DISTINCT p.id) AS playlists
+            ARRAY(
+                SELECT am.musica_ismn
+                FROM artista_musica AS am
+                WHERE am.artista_utilizador_id = a.utilizador_id
+                ORDER BY am.musica_ismn
+            ) AS musicas,
+            ARRAY(
+                SELECT aa.album_id
+                FROM album_artista AS aa
+                WHERE aa.artista_utilizador_id = a.utilizador_id
+                ORDER BY aa.album_id
+            ) AS albums,
+            ARRAY(
+                SELECT DISTINCT p.id
+                FROM artista_musica AS am
+                INNER JOIN musica_playlist AS mp ON mp.musica_ismn = am.musica_ismn
+                INNER JOIN playlist AS p ON p.id = mp.playlist_id AND p.visibilidade = true
+                WHERE am.artista_utilizador_id = a.utilizador_id
+                ORDER BY p.id
+            ) AS playlists
         FROM artista AS a
-        LEFT JOIN artista_musica AS am ON am.artista_utilizador_id = a.utilizador_id
-        LEFT JOIN musica AS m ON m.ismn = am.musica_ismn
-        LEFT JOIN album_artista AS aa ON aa.artista_utilizador_id = a.utilizador_id
-        LEFT JOIN album AS al ON al.id = aa.album_id
-        LEFT JOIN musica_playlist AS mp ON mp.musica_ismn = m.ismn
-        LEFT JOIN playlist AS p ON p.id = mp.playlist_id and p.visibilidade=true
-        WHERE a.utilizador_id = %s
-        GROUP BY a.utilizador_id;
+        WHERE a.utilizador_id = %s;
         """
         cur.execute(query, (artist_id,))
         row = cur.fetchone()
@@ -171,10 +1349,11 @@ def detail_artist(artist_id):
         if row is not None:
             artist_info = {
                 'name': row[0],
-                'songs': row[1] if row[1] != [None] else "No results",
-                'albums': row[2] if row[2] != [None] else "No results",
-                'playlists': row[3] if row[3] != [None] else "No results"
+                'songs': row[1] if row[1] else "No results",
+                'albums': row[2] if row[2] else "No results",
+                'playlists': row[3] if row[3] else "No results"
             }
+            cache_artistas.set(artist_id, artist_info)
             response = {'status': StatusCodes['success'], 'results': artist_info}
         else:
             response = {'status': StatusCodes['success'], 'results': 'No results'}
@@ -188,22 +1367,69 @@ def detail_artist(artist_id):
 
     finally:
         if conn is not None:
-            conn.close()
+            db_release(conn)
 
     return flask.jsonify(response)
 
 
+def reserva_ismns(cur, quantidade):
+    # Reserva `quantidade` valores da sequencia das musicas numa so consulta, pela ordem
+    if quantidade == 0:
+        return []
+    cur.execute("SELECT nextval('ids_musica') FROM generate_series(1, %s)", (quantidade,))
+    return [linha[0] for linha in cur.fetchall()]
+
+
+def insere_album(cur, artista, nome, data_de_lancamento, editora, novas, existentes):
+    # Insere um album do artista com as musicas novas (dicionarios validados como no /add_album) e as
+    # existentes (ismn ja confirmados), com um INSERT por tabela.
+    # Devolve (id do album, ismn das musicas novas, artistas cujas musicas mudaram)
+    cur.execute('INSERT INTO album (titulo, data_de_lancamento,gravadora_id) VALUES (%s, %s,%s) RETURNING id',
+                (nome, data_de_lancamento, editora))
+    album_id = cur.fetchone()[0]
+
+    # Inserir as músicas novas num só INSERT, com os ismn reservados antes para
+    # saber qual corresponde a cada música
+    novas_musicas = reserva_ismns(cur, len(novas))
+    psycopg2.extras.execute_values(
+        cur,
+        'INSERT INTO musica (ismn,titulo,genero,duracao,data_de_lancamento, gravadora_id) VALUES %s',
+        [(song_id, song.get('name'), song.get('type'), song.get('duration'), song.get('release_date'),
+          song.get('publisher')) for song_id, song in zip(novas_musicas, novas)],
+        page_size=1000)
+
+    # Relacionamentos entre as músicas novas e os seus artistas na tabela "artista_musica"
+    artistas_afetados = [artista]
+    values_artists = []
+    for song_id, song in zip(novas_musicas, novas):
+        other_artists = list(dict.fromkeys([artista] + [int(artist_id) for artist_id in song.get('other_artists', [])]))
+        artistas_afetados += other_artists
+        values_artists += [(artist_id, song_id) for artist_id in other_artists]
+    psycopg2.extras.execute_values(
+        cur,
+        'INSERT INTO artista_musica (artista_utilizador_id,musica_ismn) VALUES %s',
+        values_artists, page_size=1000)
+
+    # Relacionamentos entre todas as músicas (novas e existentes) e o álbum na tabela "musica_album"
+    psycopg2.extras.execute_values(
+        cur,
+        'INSERT INTO musica_album (musica_ismn,album_id) VALUES %s',
+        [(song_id, album_id) for song_id in dict.fromkeys(novas_musicas + existentes)],
+        page_size=1000)
+
+    cur.execute('INSERT INTO album_artista (album_id, artista_utilizador_id) VALUES (%s, %s)',
+                (album_id, artista))
+    return album_id, novas_musicas, artistas_afetados
+
+
 @app.route('/add_album', methods=['POST'])
 @jwt_required()
 def add_album():
-    user_payload = get_jwt_identity()
+    user_payload = utilizador_atual()
     if (user_payload['type'] == "artista"):
         logger.info('POST /add_album')
         payload = flask.request.get_json()
 
-        conn = db_connection()
-        cur = conn.cursor()
-
         logger.debug(f'POST /add_album - payload: {payload}')
 
         # Validar os campos obrigatórios
@@ -215,77 +1441,56 @@ def add_album():
             response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
             return flask.jsonify(response)
 
-        statement = 'INSERT INTO album (titulo, data_de_lancamento,gravadora_id) VALUES (%s, %s,%s) RETURNING id'
-        values = (payload['name'], payload['release_date'], payload['publisher'])
+        if not isinstance(payload['songs'], list):
+            response = {'status': StatusCodes['api_error'], 'results': 'Songs must be a list'}
+            return flask.jsonify(response)
+
+        # Validar todas as músicas antes de escrever na base de dados
+        novas = []
+        existentes = []
+        for song in payload['songs']:
+            if isinstance(song, dict):
+                if 'name' not in song or 'type' not in song or 'duration' not in song or 'release_date' not in song or 'publisher' not in song:
+                    response = {'status': StatusCodes['api_error'],
+                                'results': 'Missing required fields to create a new music'}
+                    return flask.jsonify(response)
+
+                if check_payload(song):
+                    response = {'status': StatusCodes['api_error'],
+                                'results': 'Fields cannot contain ";"'}
+                    return flask.jsonify(response)
+
+                novas += [song]
+            else:
+                # Música existente (identificador)
+                try:
+                    existentes += [int(song)]
+                except (TypeError, ValueError):
+                    response = {'status': StatusCodes['api_error'],
+                                'results': f'Give song {song} does not exist'}
+                    return flask.jsonify(response)
+
+        conn = db_connection()
+        cur = conn.cursor()
 
         try:
-            cur.execute("BEGIN")
-            cur.execute('LOCK TABLE album,musica,artista_musica,musica_album,album_artista IN EXCLUSIVE MODE')
+            inicia_transacao(cur, 'album,musica,artista_musica,musica_album,album_artista')
             # conn.begin()
-            # Inserir o álbum
-            cur.execute(statement, values)
-            album_id = cur.fetchone()[0]
-
-            # Inserir as músicas do álbum
-            songs = payload['songs']
-            for song in songs:
-                if isinstance(song, dict):
-                    if 'name' not in song or 'type' not in song or 'duration' not in song or 'release_date' not in song or 'publisher' not in song:
-                        response = {'status': StatusCodes['api_error'],
-                                    'results': 'Missing required fields to create a new music'}
-                        conn.rollback()
-                        return flask.jsonify(response)
-
-                    if check_payload(song):
-                        response = {'status': StatusCodes['api_error'],
-                                    'results': 'Fields cannot contain ";"'}
-                        conn.rollback()
-                        return flask.jsonify(response)
-
-                    # Nova música
-                    other_artists = song.get('other_artists', [])
-
-                    # Inserir a música
-                    cur.execute(
-                        'INSERT INTO musica (titulo,genero,duracao,data_de_lancamento, gravadora_id) VALUES (%s, %s, %s, %s, %s) RETURNING ismn',
-                        (song.get('name'), song.get('type'), song.get('duration'), song.get('release_date'),
-                         song.get('publisher')))
-                    song_id = cur.fetchone()[0]
-                    other_artists = [user_payload['id']] + other_artists
-                    # Inserir os relacionamentos entre a música e os outros artistas na tabela "artista_musica"
-                    if other_artists:
-                        values_artists = [(artist_id, song_id) for artist_id in other_artists]
-                        cur.executemany(
-                            'INSERT INTO artista_musica (artista_utilizador_id,musica_ismn) VALUES (%s, %s)',
-                            values_artists)
-
-                    # Inserir o relacionamento entre a música e o álbum na tabela "musica_album"
-                    cur.execute('INSERT INTO musica_album (musica_ismn,album_id) VALUES (%s, %s)', (song_id, album_id))
-                else:
-                    # Música existente (identificador)
-                    song_id = song
-
-                    if ";" in song_id:
-                        response = {'status': StatusCodes['api_error'],
-                                    'results': 'Fields cannot contain ";"'}
-                        conn.rollback()
-                        return flask.jsonify(response)
-
-                    # Verificar se a música existe na plataforma
-                    cur.execute('SELECT COUNT(*) FROM musica WHERE ismn = %s', (song_id,))
-                    count = cur.fetchone()[0]
-                    if count == 0:
-                        response = {'status': StatusCodes['api_error'],
-                                    'results': f'Give song {song_id} does not exist'}
-                        conn.rollback()
-                        return flask.jsonify(response)
-
-                    # Inserir o relacionamento entre a música existente e o álbum na tabela "musica_album"
-                    cur.execute('INSERT INTO musica_album (musica_ismn,album_id) VALUES (%s, %s)', (song_id, album_id))
-
-            cur.execute('INSERT INTO album_artista (album_id, artista_utilizador_id) VALUES (%s, %s)',
-                        (album_id, user_payload['id']))
+
+            # Verificar numa só consulta se as músicas existentes estão na plataforma
+            em_falta = musicas_em_falta(cur, existentes)
+            if em_falta:
+                response = {'status': StatusCodes['api_error'],
+                            'results': f'Give song {em_falta[0]} does not exist'}
+                conn.rollback()
+                return flask.jsonify(response)
+
+            album_id, novas_musicas, artistas_afetados = insere_album(
+                cur, user_payload['id'], payload['name'], payload['release_date'], payload['publisher'],
+                novas, existentes)
             conn.commit()
+            ingestor.regista_musicas(novas_musicas)
+            invalida_artistas(artistas_afetados)
             response = {'status': StatusCodes['success'], 'results': album_id}
 
         except (Exception, psycopg2.DatabaseError) as error:
@@ -295,7 +1500,7 @@ def add_album():
 
         finally:
             if conn is not None:
-                conn.close()
+                db_release(conn)
 
         return flask.jsonify(response)
     else:
@@ -307,7 +1512,7 @@ def add_album():
 @app.route('/<song>', methods=['PUT'])
 @jwt_required()
 def play_song(song):
-    user_payload = get_jwt_identity()
+    user_payload = utilizador_atual()
     if (user_payload['type'] == "consumidor"):
         logger.info(f'PUT / {song}')
 
@@ -315,23 +1520,24 @@ def play_song(song):
             response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
             return flask.jsonify(response)
 
+        logger.debug(f'song_id: {song}')
+
+        if PlayIngestion['mode'] == 'batched':
+            response = regista_reproducao_em_lote(song, user_payload['id'])
+            return flask.jsonify(response)
+
         conn = db_connection()
         cur = conn.cursor()
 
-        logger.debug(f'song_id: {song}')
-
         try:
-            cur.execute('BEGIN')
-            cur.execute('LOCK TABLE contagem_musica,musica IN EXCLUSIVE MODE')
+            inicia_transacao(cur, 'contagem_musica,musica')
+            bloqueia_consumidor(cur, user_payload['id'])
 
-            cur.execute('SELECT titulo FROM musica WHERE ismn=%s', (song,))
+            executa_preparada(cur, 'musica_titulo', (song,))
             flag = cur.fetchone()
             if (flag != None):
 
-                values = (data_hoje, user_payload['id'], song)
-                cur.execute(
-                    'INSERT INTO contagem_musica (data,consumidor_utilizador_id,musica_ismn) VALUES (%s,%s,%s)',
-                    values)
+                executa_preparada(cur, 'insere_reproducao', (data_hoje, user_payload['id'], song))
 
                 conn.commit()
                 response = {'status': StatusCodes['success'], 'results': "sucess"}
@@ -350,7 +1556,7 @@ def play_song(song):
 
         finally:
             if conn is not None:
-                conn.close()
+                db_release(conn)
 
         return flask.jsonify(response)
 
@@ -359,18 +1565,125 @@ def play_song(song):
         return flask.jsonify(response)
 
 
+def formata_comentarios(linhas):
+    # As linhas vêm em pré-ordem (cada resposta logo a seguir ao seu pai), por isso o pai já existe
+    comentarios = []
+    por_id = {}
+    for id_comentario, pai, texto, data, consumidor in linhas:
+        comentario = {'id': id_comentario, 'comment': texto, 'date': data.isoformat(),
+                      'consumer': consumidor, 'replies': []}
+        por_id[id_comentario] = comentario
+        if pai is None:
+            comentarios.append(comentario)
+        else:
+            por_id[pai]['replies'].append(comentario)
+    return comentarios
+
+
+@app.route('/comment/<song_id>', methods=['GET'])
+@jwt_required()
+def list_comments(song_id):
+    logger.info(f'GET /comment/{song_id}')
+
+    try:
+        song_id = int(song_id)
+        limite = int(flask.request.args.get('limit', CommentPage['default']))
+        cursor = flask.request.args.get('cursor')
+        cursor = int(cursor) if cursor is not None else None
+    except ValueError:
+        response = {'status': StatusCodes['api_error'], 'results': 'Invalid song id, limit or cursor'}
+        return flask.jsonify(response)
+
+    if limite < 1 or limite > CommentPage['max']:
+        response = {'status': StatusCodes['api_error'], 'results': f'Limit must be between 1 and {CommentPage["max"]}'}
+        return flask.jsonify(response)
+
+    # So a primeira pagina com o tamanho por omissao e guardada em cache (e a que todos os clientes pedem)
+    primeira_pagina = cursor is None and limite == CommentPage['default']
+    if primeira_pagina:
+        pagina = cache_comentarios.get(song_id)
+        if pagina is not None:
+            response = {'status': StatusCodes['success'], 'results': pagina['comments'],
+                        'next_cursor': pagina['next_cursor']}
+            return flask.jsonify(response)
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    try:
+        inicia_transacao(cur, 'comentario,comentario_comentario', so_leitura=True)
+
+        # Os comentarios de topo da musica (os que nao sao resposta a outro) sao paginados por id,
+        # que cresce com a criacao; as respostas de cada um vêm todas com ele, ordenadas pelo caminho.
+        # Uma resposta tem sempre id maior do que o comentario a que responde, logo nao ha ciclos.
+        # Le-se mais um comentario de topo do que o limite so para saber se ha uma pagina seguinte;
+        # as respostas so sao procuradas para os primeiros limite
+        cur.execute('''
+            WITH RECURSIVE candidatas AS (
+                SELECT c.id
+                FROM comentario AS c
+                WHERE c.musica_ismn = %(musica)s
+                  AND (%(cursor)s::INTEGER IS NULL OR c.id > %(cursor)s::INTEGER)
+                  AND NOT EXISTS (SELECT 1 FROM comentario_comentario AS cc WHERE cc.comentario_id1 = c.id)
+                ORDER BY c.id
+                LIMIT %(limite)s + 1
+            ),
+            raizes AS (
+                SELECT id FROM candidatas ORDER BY id LIMIT %(limite)s
+            ),
+            fio AS (
+                SELECT r.id, NULL::INTEGER AS pai, ARRAY[r.id] AS caminho
+                FROM raizes AS r
+                UNION ALL
+                SELECT cc.comentario_id1, f.id, f.caminho || cc.comentario_id1
+                FROM fio AS f
+                INNER JOIN comentario_comentario AS cc ON cc.comentario_id = f.id
+            )
+            SELECT f.id, f.pai, c.texto, c.data_de_criacao, c.consumidor_utilizador_id,
+                   (SELECT count(*) FROM candidatas) > %(limite)s AS mais
+            FROM fio AS f
+            INNER JOIN comentario AS c ON c.id = f.id
+            ORDER BY f.caminho
+        ''', {'musica': song_id, 'cursor': cursor, 'limite': limite})
+        linhas = cur.fetchall()
+
+        if not linhas and cursor is None:
+            cur.execute('SELECT 1 FROM musica WHERE ismn = %s', (song_id,))
+            if cur.fetchone() is None:
+                conn.commit()
+                response = {'status': StatusCodes['api_error'], 'results': 'Given song does not exist'}
+                return flask.jsonify(response)
+
+        conn.commit()
+
+        comentarios = formata_comentarios([linha[:5] for linha in linhas])
+        proximo_cursor = str(comentarios[-1]['id']) if linhas and linhas[0][5] else None
+
+        if primeira_pagina:
+            cache_comentarios.set(song_id, {'comments': comentarios, 'next_cursor': proximo_cursor})
+        response = {'status': StatusCodes['success'], 'results': comentarios, 'next_cursor': proximo_cursor}
+
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f'GET /comment/{song_id} - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            db_release(conn)
+
+    return flask.jsonify(response)
+
+
 @app.route('/comment/<song_id>/<parent_id_comment>', methods=['POST'])
 @app.route('/comment/<song_id>', methods=['POST'])
 @jwt_required()
 def make_comment(song_id, parent_id_comment=None):
-    user_payload = get_jwt_identity()
+    user_payload = utilizador_atual()
     if (user_payload['type'] == "consumidor"):
         logger.info('POST /comment')
         payload = flask.request.get_json()
 
-        conn = db_connection()
-        cur = conn.cursor()
-
         logger.debug(f'song_id: {song_id}, parent_id_comment: {parent_id_comment}')
         if ";" in song_id:
             response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
@@ -393,55 +1706,53 @@ def make_comment(song_id, parent_id_comment=None):
             return flask.jsonify(response)
 
         try:
-            cur.execute('BEGIN')
-            cur.execute('LOCK TABLE comentario,comentario_comentario IN EXCLUSIVE MODE')
+            song_id = int(song_id)
+            if parent_id_comment is not None:
+                parent_id_comment = int(parent_id_comment)
+        except ValueError:
+            response = {'status': StatusCodes['api_error'], 'results': 'Invalid song or comment id'}
+            return flask.jsonify(response)
 
-            cur.execute('SELECT ismn FROM musica WHERE ismn=%s', (song_id,))
+        conn = db_connection()
+        cur = conn.cursor()
 
-            if cur.fetchone() is None:
-                response = {'status': StatusCodes['api_error'],
-                            'results': 'Given song does not exist'}
-                conn.rollback()
-                return flask.jsonify(response)
+        try:
+            inicia_transacao(cur, 'comentario,comentario_comentario')
 
-            if (parent_id_comment != None):
-                cur.execute('SELECT musica_ismn FROM comentario WHERE id=%s', (parent_id_comment,))
-                musica = cur.fetchone()
-                if musica is None:
-                    response = {'status': StatusCodes['api_error'],
-                                'results': 'Given comment does not exist'}
-                    conn.rollback()
-                    return flask.jsonify(response)
+            # Sem bloquear as tabelas (modo 'row'): a existencia da musica fica a cargo da chave estrangeira, e a resposta
+            # so e inserida se o comentario pai existir e for da mesma musica, tudo numa so instrucao (insere_comentario)
+            executa_preparada(cur, 'insere_comentario',
+                              (payload['comment'], data_hoje, song_id, user_payload['id'], parent_id_comment))
+            id_novo_comentario, musica_do_pai = cur.fetchone()
 
-                if (musica[0] != int(song_id)):
+            if id_novo_comentario is None:
+                conn.rollback()
+                if musica_do_pai is None:
+                    response = {'status': StatusCodes['api_error'], 'results': 'Given comment does not exist'}
+                else:
                     response = {'status': StatusCodes['api_error'],
                                 'results': 'Given comment does not refer to given song'}
-                    conn.rollback()
-                    return flask.jsonify(response)
-
-            values = (payload['comment'], data_hoje, song_id, user_payload['id'])
-            cur.execute(
-                'INSERT INTO comentario (texto,data_de_criacao,musica_ismn,consumidor_utilizador_id) VALUES (%s,%s,%s,%s) RETURNING id',
-                values)
-            id_novo_comentario = cur.fetchone()[0]
-
-            if (parent_id_comment != None):
-                values = (parent_id_comment, id_novo_comentario)
-                cur.execute(
-                    'INSERT INTO comentario_comentario (comentario_id,comentario_id1) VALUES (%s,%s)',
-                    values)
+            else:
+                conn.commit()
+                cache_comentarios.delete(song_id)
+                response = {'status': StatusCodes['success'], 'results': id_novo_comentario}
 
-            conn.commit()
-            response = {'status': StatusCodes['success'], 'results': id_novo_comentario}
+        except psycopg2.IntegrityError as error:
+            conn.rollback()
+            if error.diag.constraint_name == 'comentario_fk1':
+                response = {'status': StatusCodes['api_error'], 'results': 'Given song does not exist'}
+            else:
+                logger.error(f'POST /comment - error: {error}')
+                response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
         except (Exception, psycopg2.DatabaseError) as error:
-            logger.error(f'POST /add_playlist - error: {error}')
+            logger.error(f'POST /comment - error: {error}')
             response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
             conn.rollback()
 
         finally:
             if conn is not None:
-                conn.close()
+                db_release(conn)
 
         return flask.jsonify(response)
 
@@ -458,103 +1769,295 @@ def traduz_visibilidade(visibility):
         return False
 
 
-def procura_tipo_de_plano(consulta):
-    data_de_validade = None
-    for linha in consulta:
-        if linha[0] is None:
-            temp = "Regular"
-        elif data_hoje < linha[0]:
-            temp = "Premium"
-            data_de_validade = linha[0]
+def procura_tipo_de_plano(data_de_validade):
+    if data_de_validade is not None and data_hoje < data_de_validade:
+        return "Premium", data_de_validade
+    return "Regular", None
+
+
+def le_plano(cur, consumidor_id):
+    # plano_atual guarda a maior data de validade de cada consumidor (mantida por trigger em subscricao)
+    executa_preparada(cur, 'plano_atual', (consumidor_id,))
+    linha = cur.fetchone()
+    return linha[0] if linha is not None else None
+
+
+def plano_do_consumidor(cur, consumidor_id):
+    plano = cache_planos.get(consumidor_id)
+    if plano is not None:
+        data_de_validade = datetime.date.fromisoformat(plano['validade']) if plano['validade'] else None
+        return procura_tipo_de_plano(data_de_validade)
+
+    data_de_validade = le_plano(cur, consumidor_id)
+    tipo_de_plano, data_de_validade = procura_tipo_de_plano(data_de_validade)
+
+    # Um plano Premium fica em cache ate ao dia em que expira; um Regular so durante o TTL
+    # curto, porque pode passar a Premium numa subscricao feita noutro processo
+    if tipo_de_plano == "Premium":
+        expira = datetime.datetime.combine(data_de_validade, datetime.time.min) - datetime.datetime.now()
+        ttl = min(expira.total_seconds(), CacheConfig['plan_max_ttl'])
+        plano = {'validade': data_de_validade.isoformat()}
+    else:
+        ttl = CacheConfig['plan_regular_ttl']
+        plano = {'validade': None}
+    if ttl > 0:
+        cache_planos.set(consumidor_id, plano, ttl)
+    return tipo_de_plano, data_de_validade
+
+
+def le_lista_de_musicas(songs):
+    # Ids das musicas como inteiros, sem repetidos e pela ordem dada; None se a lista for invalida
+    if not isinstance(songs, list):
+        return None
+    try:
+        return list(dict.fromkeys(int(song) for song in songs))
+    except (TypeError, ValueError):
+        return None
+
+
+def musicas_em_falta(cur, ismns):
+    # Valida todas as musicas numa so consulta e devolve as que nao existem
+    cur.execute('SELECT pedidas.ismn FROM unnest(%s::INTEGER[]) WITH ORDINALITY AS pedidas (ismn, ordem) '
+                'WHERE NOT EXISTS (SELECT 1 FROM musica AS m WHERE m.ismn = pedidas.ismn) ORDER BY pedidas.ordem',
+                (ismns,))
+    return [linha[0] for linha in cur.fetchall()]
+
+
+def insere_musicas_playlist(cur, id_playlist, ismns):
+    # Insercao em lotes de varias linhas; musicas que ja estejam na playlist sao ignoradas
+    inseridas = psycopg2.extras.execute_values(
+        cur,
+        'INSERT INTO musica_playlist (musica_ismn,playlist_id) VALUES %s ON CONFLICT DO NOTHING RETURNING musica_ismn',
+        [(ismn, id_playlist) for ismn in ismns], page_size=1000, fetch=True)
+    return len(inseridas)
+
+
+def artistas_das_musicas(cur, ismns):
+    if not ismns:
+        return []
+    cur.execute('SELECT DISTINCT artista_utilizador_id FROM artista_musica WHERE musica_ismn = ANY(%s::INTEGER[])',
+                (ismns,))
+    return [linha[0] for linha in cur.fetchall()]
+
+
+@app.route('/add_playlist', methods=['POST'])
+@jwt_required()
+def create_playlist():
+    user_payload = utilizador_atual()
+    if (user_payload['type'] == "consumidor"):
+        logger.info('POST /add_playlist')
+        payload = flask.request.get_json()
+
+        logger.debug(f'POST /add_playlist - payload: {payload}')
+
+        # Validar os campos obrigatórios
+        if 'playlist_name' not in payload or 'visibility' not in payload or 'songs' not in payload:
+            response = {'status': StatusCodes['api_error'], 'results': 'Missing required fields'}
+            return flask.jsonify(response)
+
+        if check_payload(payload):
+            response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
+            return flask.jsonify(response)
+
+        if payload['playlist_name'] == "TOP10":
+            response = {'status': StatusCodes['api_error'], 'results': 'Playlist name "TOP10" not allowed'}
+            return flask.jsonify(response)
+
+        songs = le_lista_de_musicas(payload['songs'])
+        if songs is None:
+            response = {'status': StatusCodes['api_error'], 'results': 'Songs must be a list of song ids'}
+            return flask.jsonify(response)
+
+        conn = db_connection()
+        cur = conn.cursor()
+
+        try:
+            inicia_transacao(cur, 'subscricao,playlist,musica_playlist')
+
+            tipo_de_plano, data_de_validade = plano_do_consumidor(cur, user_payload['id'])
+            if (tipo_de_plano == "Premium"):
+                em_falta = musicas_em_falta(cur, songs)
+                if em_falta:
+                    response = {'status': StatusCodes['api_error'], 'results': f'Given songs do not exist: {em_falta}'}
+                    conn.rollback()
+                    return flask.jsonify(response)
+
+                values = (payload['playlist_name'], traduz_visibilidade(payload['visibility']), user_payload['id'])
+                cur.execute(
+                    'INSERT INTO playlist (nome,visibilidade,consumidor_utilizador_id) VALUES (%s,%s,%s) RETURNING id',
+                    values)
+                id_playlist = cur.fetchone()[0]
+
+                insere_musicas_playlist(cur, id_playlist, songs)
+
+                # Uma playlist publica aparece no /artist_info dos artistas das suas musicas
+                artistas_afetados = []
+                if traduz_visibilidade(payload['visibility']):
+                    artistas_afetados = artistas_das_musicas(cur, songs)
+
+                response = {'status': StatusCodes['success'], 'results': id_playlist}
+
+            else:
+                response = {'status': StatusCodes['api_error'],
+                            'results': 'Only premium consumers can create a playlist'}
+                conn.rollback()
+                return flask.jsonify(response)
+
+            conn.commit()
+            invalida_artistas(artistas_afetados)
+
+
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'POST /add_playlist - error: {error}')
+            response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+            conn.rollback()
+
+        finally:
+            if conn is not None:
+                db_release(conn)
+
+        return flask.jsonify(response)
 
-    return temp, data_de_validade
+    else:
+        response = {'status': StatusCodes['api_error'], 'results': 'Only consumers can create a playlist'}
+        return flask.jsonify(response)
 
 
-@app.route('/add_playlist', methods=['POST'])
+@app.route('/playlist/<playlist_id>/songs', methods=['POST'])
 @jwt_required()
-def create_playlist():
-    user_payload = get_jwt_identity()
+def append_playlist(playlist_id):
+    user_payload = utilizador_atual()
     if (user_payload['type'] == "consumidor"):
-        logger.info('POST /add_playlist')
+        logger.info(f'POST /playlist/{playlist_id}/songs')
         payload = flask.request.get_json()
 
-        conn = db_connection()
-        cur = conn.cursor()
+        logger.debug(f'POST /playlist/{playlist_id}/songs - payload: {payload}')
 
-        logger.debug(f'POST /add_playlist - payload: {payload}')
+        try:
+            playlist_id = int(playlist_id)
+        except ValueError:
+            response = {'status': StatusCodes['api_error'], 'results': 'Given playlist id is not valid'}
+            return flask.jsonify(response)
 
-        # Validar os campos obrigatórios
-        if 'playlist_name' not in payload or 'visibility' not in payload or 'songs' not in payload:
+        if 'songs' not in payload:
             response = {'status': StatusCodes['api_error'], 'results': 'Missing required fields'}
             return flask.jsonify(response)
 
-        if check_payload(payload):
-            response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
+        songs = le_lista_de_musicas(payload['songs'])
+        if songs is None:
+            response = {'status': StatusCodes['api_error'], 'results': 'Songs must be a list of song ids'}
             return flask.jsonify(response)
 
-        if payload['playlist_name'] == "TOP10":
-            response = {'status': StatusCodes['api_error'], 'results': 'Playlist name "TOP10" not allowed'}
-            return flask.jsonify(response)
+        conn = db_connection()
+        cur = conn.cursor()
 
         try:
-            cur.execute('BEGIN')
-            cur.execute('LOCK TABLE subscricao,playlist,musica_playlist IN EXCLUSIVE MODE')
-
-            cur.execute('SELECT data_de_validade FROM subscricao WHERE consumidor_utilizador_id=%s',
-                        (user_payload['id'],))
-
-            consulta = cur.fetchall()
-            tipo_de_plano, data_de_validade = procura_tipo_de_plano(consulta)
-            if (tipo_de_plano == "Premium"):
-                values = (payload['playlist_name'], traduz_visibilidade(payload['visibility']), user_payload['id'])
-                cur.execute(
-                    'INSERT INTO playlist (nome,visibilidade,consumidor_utilizador_id) VALUES (%s,%s,%s) RETURNING id',
-                    values)
-                id_playlist = cur.fetchone()[0]
+            inicia_transacao(cur, 'subscricao,playlist,musica_playlist')
 
-                for song in payload['songs']:
-                    values = (song, id_playlist)
-                    cur.execute('INSERT INTO musica_playlist (musica_ismn,playlist_id) VALUES (%s,%s)', values)
+            cur.execute('SELECT nome,visibilidade FROM playlist WHERE id=%s AND consumidor_utilizador_id=%s',
+                        (playlist_id, user_payload['id']))
+            playlist = cur.fetchone()
+            if playlist is None:
+                response = {'status': StatusCodes['api_error'], 'results': 'Given playlist does not exist'}
+                conn.rollback()
+                return flask.jsonify(response)
 
-                response = {'status': StatusCodes['success'], 'results': id_playlist}
+            if playlist[0] == "TOP10":
+                response = {'status': StatusCodes['api_error'], 'results': 'Playlist "TOP10" cannot be changed'}
+                conn.rollback()
+                return flask.jsonify(response)
 
-            else:
+            tipo_de_plano, data_de_validade = plano_do_consumidor(cur, user_payload['id'])
+            if (tipo_de_plano != "Premium"):
                 response = {'status': StatusCodes['api_error'],
-                            'results': 'Only premium consumers can create a playlist'}
+                            'results': 'Only premium consumers can change a playlist'}
                 conn.rollback()
                 return flask.jsonify(response)
 
-            conn.commit()
+            em_falta = musicas_em_falta(cur, songs)
+            if em_falta:
+                response = {'status': StatusCodes['api_error'], 'results': f'Given songs do not exist: {em_falta}'}
+                conn.rollback()
+                return flask.jsonify(response)
 
+            adicionadas = insere_musicas_playlist(cur, playlist_id, songs)
+            artistas_afetados = artistas_das_musicas(cur, songs) if playlist[1] else []
 
+            conn.commit()
+            invalida_artistas(artistas_afetados)
+            response = {'status': StatusCodes['success'], 'results': adicionadas}
 
         except (Exception, psycopg2.DatabaseError) as error:
-            logger.error(f'POST /add_playlist - error: {error}')
+            logger.error(f'POST /playlist/{playlist_id}/songs - error: {error}')
             response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
             conn.rollback()
 
         finally:
             if conn is not None:
-                conn.close()
+                db_release(conn)
 
         return flask.jsonify(response)
 
     else:
-        response = {'status': StatusCodes['api_error'], 'results': 'Only consumers can create a playlist'}
+        response = {'status': StatusCodes['api_error'], 'results': 'Only consumers can change a playlist'}
         return flask.jsonify(response)
 
 
+def insere_cartoes(cur, quantidade, valor, validade, admin_id):
+    # Gera os ids em memoria e insere-os num unico INSERT; so os que colidirem com
+    # cartoes ja existentes sao gerados de novo
+    ids = []
+    while len(ids) < quantidade:
+        candidatos = {}
+        while len(candidatos) < quantidade - len(ids):
+            identity = generate_random_sequence()
+            candidatos[int(identity)] = identity
+
+        values = [(identity, valor, validade, valor, admin_id) for identity in candidatos.values()]
+        inseridos = psycopg2.extras.execute_values(
+            cur,
+            'INSERT INTO cartao_pre_pago (id,valor,data_de_validade,valor_restante,administrador_utilizador_id) VALUES %s '
+            'ON CONFLICT (id) DO NOTHING RETURNING id',
+            values, page_size=len(values), fetch=True)
+        ids += [candidatos[linha[0]] for linha in inseridos]
+    return ids
+
+
+def gera_cartoes_em_stream(quantidade, valor, validade, admin_id):
+    # Cada lote e confirmado antes de os seus ids serem enviados, por isso um erro a meio
+    # deixa gravados apenas os cartoes ja enviados ao cliente
+    conn = db_connection()
+    cur = conn.cursor()
+    gerados = 0
+    try:
+        yield '{"status": %d, "results": [' % StatusCodes['success']
+        while gerados < quantidade:
+            lote = min(CardGeneration['batch'], quantidade - gerados)
+            inicia_transacao(cur, 'cartao_pre_pago')
+            ids = insere_cartoes(cur, lote, valor, validade, admin_id)
+            conn.commit()
+            yield (', ' if gerados else '') + ', '.join(json.dumps(identity) for identity in ids)
+            gerados += lote
+        yield ']}'
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /card - error after {gerados} cards: {error}')
+        conn.rollback()
+        yield '], "errors": %s}' % json.dumps(str(error))
+
+    finally:
+        db_release(conn)
+
+
 @app.route('/card', methods=['POST'])
 @jwt_required()
 def generate_card():
-    user_payload = get_jwt_identity()
+    user_payload = utilizador_atual()
     if (user_payload['type'] == "administrador"):
         logger.info('POST /card')
         payload = flask.request.get_json()
 
-        conn = db_connection()
-        cur = conn.cursor()
-
         logger.debug(f'POST /card - payload: {payload}')
 
         # Validar os campos obrigatórios
@@ -573,25 +2076,28 @@ def generate_card():
             return flask.jsonify(response)
 
         try:
-            ids = []
-            cur.execute('BEGIN')
-            cur.execute('LOCK TABLE cartao_pre_pago IN EXCLUSIVE MODE')
-            for i in range(int(payload['number_cards'])):
-                var = 1
-                while (var):
-                    identity = generate_random_sequence()
-                    cur.execute('SELECT * FROM cartao_pre_pago WHERE id=%s', (identity,))
-                    if (cur.fetchone() is None):
-                        var = 0
-
-                # print(identity)
-                values = (identity, payload['card_price'],
-                          datetime.date(int(str(data_hoje).split("-")[0]) + 1, int(str(data_hoje).split("-")[1]),
-                                        int(str(data_hoje).split("-")[2])), payload['card_price'], user_payload['id'])
-                cur.execute(
-                    'INSERT INTO cartao_pre_pago (id,valor,data_de_validade,valor_restante,administrador_utilizador_id) VALUES (%s,%s,%s,%s,%s)',
-                    values)
-                ids += [identity]
+            number_cards = int(payload['number_cards'])
+        except (TypeError, ValueError):
+            number_cards = 0
+        if number_cards < 1:
+            response = {'status': StatusCodes['api_error'], 'results': 'Number of cards must be a positive integer'}
+            return flask.jsonify(response)
+
+        validade = datetime.date(int(str(data_hoje).split("-")[0]) + 1, int(str(data_hoje).split("-")[1]),
+                                 int(str(data_hoje).split("-")[2]))
+
+        # Lotes muito grandes sao gravados e enviados ao cliente aos poucos
+        if number_cards > CardGeneration['stream_threshold']:
+            return flask.Response(gera_cartoes_em_stream(number_cards, payload['card_price'], validade,
+                                                         user_payload['id']),
+                                  mimetype='application/json')
+
+        conn = db_connection()
+        cur = conn.cursor()
+
+        try:
+            inicia_transacao(cur, 'cartao_pre_pago')
+            ids = insere_cartoes(cur, number_cards, payload['card_price'], validade, user_payload['id'])
 
             conn.commit()
             response = {'status': StatusCodes['success'], 'results': ids}
@@ -603,7 +2109,7 @@ def generate_card():
 
         finally:
             if conn is not None:
-                conn.close()
+                db_release(conn)
 
         return flask.jsonify(response)
 
@@ -626,14 +2132,11 @@ def soma_datas(data, periodo):
 @app.route('/subscribe', methods=['POST'])
 @jwt_required()
 def subscription():
-    user_payload = get_jwt_identity()
+    user_payload = utilizador_atual()
     if (user_payload['type'] == "consumidor"):
         logger.info('POST /subscribe')
         payload = flask.request.get_json()
 
-        conn = db_connection()
-        cur = conn.cursor()
-
         logger.debug(f'POST /subscribe - payload: {payload}')
 
         # Validar os campos obrigatórios
@@ -652,28 +2155,54 @@ def subscription():
             return flask.jsonify(response)
 
         try:
-            cur.execute('BEGIN')
-            cur.execute('LOCK TABLE cartao_pre_pago,subscricao,subscricao_cartao_pre_pago IN EXCLUSIVE MODE')
+            # Sem cartoes repetidos, pela ordem em que foram dados
+            cards = list(dict.fromkeys(int(card) for card in payload['cards']))
+        except (TypeError, ValueError):
+            response = {'status': StatusCodes['api_error'], 'results': 'Cards must be a list of card ids'}
+            return flask.jsonify(response)
+
+        conn = db_connection()
+        cur = conn.cursor()
+
+        try:
+            inicia_transacao(cur, 'cartao_pre_pago,subscricao,subscricao_cartao_pre_pago')
+            bloqueia_consumidor(cur, user_payload['id'])
 
             dicio = {'month': 7, 'quarter': 21, 'semester': 42}
+
+            # Todos os cartoes numa so consulta; bloqueados por ordem de id para que
+            # subscricoes concorrentes com cartoes em comum nao entrem em deadlock
+            cur.execute('SELECT id,data_de_validade,valor_restante FROM cartao_pre_pago '
+                        'WHERE id = ANY(%s::BIGINT[]) ORDER BY id FOR UPDATE', (cards,))
+            linhas = {linha[0]: linha[1:] for linha in cur.fetchall()}
+
             total = 0
             cartoes = []
-            for card in payload['cards']:
-                cur.execute('SELECT data_de_validade,valor_restante FROM cartao_pre_pago WHERE id=%s', (card,))
-                linha = cur.fetchone()
+            for card in cards:
+                linha = linhas.get(card)
+                if linha is None:
+                    response = {'status': StatusCodes['api_error'], 'results': f'Card {card} does not exist'}
+                    conn.rollback()
+                    return flask.jsonify(response)
                 if data_hoje <= linha[0] and int(linha[1]) > 0 and total < dicio[payload['period']]:
                     total += int(linha[1])
                     cartoes += [[card, int(linha[1])]]
             total2 = 0
             if (total >= dicio[payload['period']]):
 
+                # O ultimo cartao usado fica com o troco, os restantes ficam a zero
+                valores = []
                 for cartao in cartoes:
                     total2 += cartao[1]
                     if (total2 != total):
-                        cur.execute('UPDATE cartao_pre_pago SET valor_restante = %s WHERE id=%s', (0, cartao[0],))
+                        valores += [(cartao[0], 0)]
                     else:
-                        cur.execute('UPDATE cartao_pre_pago SET valor_restante = %s WHERE id=%s',
-                                    (total - dicio[payload['period']], cartao[0],))
+                        valores += [(cartao[0], total - dicio[payload['period']])]
+                psycopg2.extras.execute_values(
+                    cur,
+                    'UPDATE cartao_pre_pago AS c SET valor_restante = v.valor_restante '
+                    'FROM (VALUES %s) AS v (id, valor_restante) WHERE c.id = v.id',
+                    valores, template='(%s::BIGINT, %s::FLOAT8)', page_size=len(valores))
 
             else:
                 response = {'status': StatusCodes['api_error'],
@@ -681,11 +2210,8 @@ def subscription():
                 conn.rollback()
                 return flask.jsonify(response)
 
-            cur.execute('SELECT data_de_validade FROM subscricao WHERE consumidor_utilizador_id=%s',
-                        (user_payload['id'],))
-
-            consulta = cur.fetchall()
-            tipo_de_plano, data_de_validade = procura_tipo_de_plano(consulta)
+            # A nova validade e calculada a partir do plano atual, por isso le sempre da base de dados
+            tipo_de_plano, data_de_validade = procura_tipo_de_plano(le_plano(cur, user_payload['id']))
             id_subscricao = ""
 
             if (tipo_de_plano == 'Regular'):
@@ -701,11 +2227,13 @@ def subscription():
                 cur.execute(statement, values)
                 id_subscricao = cur.fetchone()[0]
 
-            for cartao in cartoes:
-                cur.execute('INSERT INTO subscricao_cartao_pre_pago (subscricao_id,cartao_pre_pago_id) VALUES (%s,%s)',
-                            (id_subscricao, cartao[0],))
+            psycopg2.extras.execute_values(
+                cur,
+                'INSERT INTO subscricao_cartao_pre_pago (subscricao_id,cartao_pre_pago_id) VALUES %s',
+                [(id_subscricao, cartao[0]) for cartao in cartoes], page_size=len(cartoes))
 
             conn.commit()
+            cache_planos.delete(user_payload['id'])
 
             response = {'status': StatusCodes['success'], 'results': id_subscricao}
 
@@ -716,7 +2244,7 @@ def subscription():
 
         finally:
             if conn is not None:
-                conn.close()
+                db_release(conn)
 
         return flask.jsonify(response)
 
@@ -731,38 +2259,26 @@ def generate_random_sequence():
 
 
 def formata_search_song(consulta):
-    saida = []
-    linha = ["", [], []]
-
-    for i in range(len(consulta)):
-        if consulta[i][0] != linha[0]:
-            if (i != 0):
-                saida += [linha]
-            linha = [consulta[i][0], [consulta[i][1]], [consulta[i][2]]]
-            if (i == len(consulta) - 1):
-                saida += [linha]
-        else:
-            if consulta[i][1][0] != linha[1][0]:
-                linha[1] += [consulta[i][1]]
-                if (i == len(consulta) - 1):
-                    saida += [linha]
-            else:
-                if consulta[i][2][0] != linha[2][0]:
-                    if consulta[i][2] is not None:
-                        linha[2] += [consulta[i][2]]
-                    if i == len(consulta) - 1:
-                        saida += [linha]
+    # Cada linha ja vem agregada por musica: (titulo, [artistas], [albuns], score, ismn)
     res = []
-    for elemento in saida:
+    for linha in consulta:
         resultados = {
-            "song_title": elemento[0],
-            "artists": elemento[1] if elemento[1] != [None] else "No results",
-            "albuns": elemento[2] if elemento[2] != [None] else "No results"
+            "song_title": linha[0],
+            "artists": linha[1] if linha[1] else "No results",
+            "albuns": linha[2] if linha[2] else "No results"
         }
         res.append(resultados)
     return res
 
 
+def le_cursor_pesquisa(cursor):
+    # O cursor e a pontuacao e o ismn da ultima musica da pagina anterior: "<score>:<ismn>"
+    if cursor is None:
+        return None, None
+    score, ismn = cursor.split(':')
+    return float(score), int(ismn)
+
+
 @app.route('/search_song/<keyword>', methods=['GET'])
 @jwt_required()
 def search_song(keyword):
@@ -774,24 +2290,85 @@ def search_song(keyword):
         response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
         return flask.jsonify(response)
 
+    try:
+        limite = int(flask.request.args.get('limit', SearchPage['default']))
+        cursor = le_cursor_pesquisa(flask.request.args.get('cursor'))
+    except ValueError:
+        response = {'status': StatusCodes['api_error'], 'results': 'Invalid limit or cursor'}
+        return flask.jsonify(response)
+
+    if limite < 1 or limite > SearchPage['max']:
+        response = {'status': StatusCodes['api_error'], 'results': f'Limit must be between 1 and {SearchPage["max"]}'}
+        return flask.jsonify(response)
+
     conn = db_connection()
     cur = conn.cursor()
 
     try:
-        cur.execute('BEGIN')
-        cur.execute('LOCK TABLE musica,artista,artista_musica,album,musica_album IN EXCLUSIVE MODE')
-
-        cur.execute('SELECT m.titulo AS nome_musica, a.nome_artistico, al.id '
-                    'FROM musica AS m '
-                    'LEFT JOIN artista_musica AS am ON m.ismn = am.musica_ismn '
-                    'LEFT JOIN artista AS a ON am.artista_utilizador_id = a.utilizador_id '
-                    'LEFT JOIN musica_album AS ma ON m.ismn = ma.musica_ismn '
-                    'LEFT JOIN album AS al ON ma.album_id = al.id '
-                    'WHERE m.titulo LIKE %s', (f"%{keyword}%",))
+        inicia_transacao(cur, 'musica,artista,artista_musica,album,musica_album', so_leitura=True)
+
+        # Os ILIKE usam os indices de trigramas em musica.titulo e artista.nome_artistico;
+        # cada musica fica com a melhor pontuacao entre o titulo e os nomes dos seus artistas.
+        # Os artistas e albuns sao agregados por musica na base de dados, uma linha por musica
+        padrao = '%' + keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        cur.execute('''
+            WITH candidatas AS (
+                SELECT m.ismn, word_similarity(%(keyword)s, m.titulo) AS semelhanca
+                FROM musica AS m
+                WHERE m.titulo ILIKE %(padrao)s
+                UNION ALL
+                SELECT am.musica_ismn, word_similarity(%(keyword)s, a.nome_artistico) AS semelhanca
+                FROM artista AS a
+                INNER JOIN artista_musica AS am ON am.artista_utilizador_id = a.utilizador_id
+                WHERE a.nome_artistico ILIKE %(padrao)s
+            ),
+            pagina AS (
+                SELECT ismn, MAX(semelhanca)::REAL AS score
+                FROM candidatas
+                GROUP BY ismn
+                HAVING %(cursor_score)s::REAL IS NULL
+                    OR MAX(semelhanca)::REAL < %(cursor_score)s::REAL
+                    OR (MAX(semelhanca)::REAL = %(cursor_score)s::REAL AND ismn > %(cursor_ismn)s)
+                ORDER BY score DESC, ismn
+                LIMIT %(limite)s
+            )
+            SELECT
+                m.titulo AS nome_musica,
+                ARRAY(
+                    SELECT a.nome_artistico
+                    FROM artista_musica AS am
+                    INNER JOIN artista AS a ON am.artista_utilizador_id = a.utilizador_id
+                    WHERE am.musica_ismn = p.ismn
+                    ORDER BY a.nome_artistico
+                    LIMIT %(fanout)s
+                ) AS artistas,
+                ARRAY(
+                    SELECT ma.album_id
+                    FROM musica_album AS ma
+                    WHERE ma.musica_ismn = p.ismn
+                    ORDER BY ma.album_id
+                    LIMIT %(fanout)s
+                ) AS albuns,
+                p.score,
+                p.ismn
+            FROM pagina AS p
+            INNER JOIN musica AS m ON m.ismn = p.ismn
+            ORDER BY p.score DESC, p.ismn
+        ''', {'keyword': keyword, 'padrao': padrao, 'cursor_score': cursor[0], 'cursor_ismn': cursor[1],
+              'limite': limite + 1, 'fanout': SearchPage['fanout']})
 
         consulta = cur.fetchall()
         # print(consulta)
-        response = {'status': StatusCodes['success'], 'results': formata_search_song(consulta)}
+
+        # Foi pedida mais uma musica do que o limite so para saber se existe uma pagina seguinte
+        proximo_cursor = None
+        if len(consulta) > limite:
+            consulta = consulta[:limite]
+            ultima = consulta[-1]
+            proximo_cursor = f'{ultima[3]!r}:{ultima[4]}'
+
+        response = {'status': StatusCodes['success'], 'results': formata_search_song(consulta),
+                    'next_cursor': proximo_cursor}
         conn.commit()
 
     except (Exception, psycopg2.DatabaseError) as error:
@@ -801,7 +2378,7 @@ def search_song(keyword):
 
     finally:
         if conn is not None:
-            conn.close()
+            db_release(conn)
 
     return flask.jsonify(response)
 
@@ -810,21 +2387,18 @@ def search_song(keyword):
 @jwt_required()
 def teste1():
     response = "permission granted"
-    response += ' ' + get_jwt_identity()['type']
+    response += ' ' + utilizador_atual()['type']
     return flask.jsonify(response)
 
 
 @app.route('/add_song', methods=['POST'])
 @jwt_required()
 def add_song():
-    user_payload = get_jwt_identity()
+    user_payload = utilizador_atual()
     if (user_payload['type'] == "artista"):
         logger.info('POST /add_song')
         payload = flask.request.get_json()
 
-        conn = db_connection()
-        cur = conn.cursor()
-
         logger.debug(f'POST /add_song - payload: {payload}')
 
         # Validar os campos obrigat贸rios
@@ -840,9 +2414,11 @@ def add_song():
         values = (payload['name'], payload['type'], payload['duration'],
                   payload['release_date'], payload['publisher'])
         other_artists = payload.get('other_artists', [])
+        conn = db_connection()
+        cur = conn.cursor()
+
         try:
-            cur.execute('BEGIN')
-            cur.execute('LOCK TABLE artista_musica,musica IN EXCLUSIVE MODE')
+            inicia_transacao(cur, 'artista_musica,musica')
             # conn.begin()
             # Inserir a música
             cur.execute(statement, values)
@@ -860,6 +2436,8 @@ def add_song():
                                 values_artists)
 
             conn.commit()
+            ingestor.regista_musicas([musica_id])
+            invalida_artistas(other_artists)
             response = {'status': StatusCodes['success'], 'results': musica_id}
 
         except (Exception, psycopg2.DatabaseError) as error:
@@ -869,7 +2447,7 @@ def add_song():
 
         finally:
             if conn is not None:
-                conn.close()
+                db_release(conn)
 
         return flask.jsonify(response)
     else:
@@ -878,14 +2456,64 @@ def add_song():
         return flask.jsonify(response)
 
 
+def le_utilizador(username):
+    # Devolve (hash da palavra-passe, id, tipo) do utilizador, ou None se nao existir.
+    # Com o id e o tipo em cache, o hash e lido pela chave primaria; sem cache, tudo numa leitura
+    # pelo indice unico de username. Nenhuma bloqueia tabelas
+    em_cache = cache_logins.get(username)
+
+    conn = db_connection()
+    cur = conn.cursor()
+    try:
+        if em_cache is not None:
+            id_utilizador, tipo = em_cache
+            executa_preparada(cur, 'palavra_passe_por_id', (id_utilizador,))
+            linha = cur.fetchone()
+            utilizador = None if linha is None else (linha[0], id_utilizador, tipo)
+        else:
+            executa_preparada(cur, 'utilizador_por_username', (username,))
+            utilizador = cur.fetchone()
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        db_release(conn)
+
+    # Um utilizador sem tipo (a meio de ser criado) nao pode entrar, e nao fica em cache
+    if utilizador is None or utilizador[2] is None:
+        if em_cache is not None:
+            cache_logins.delete(username)
+        return None
+    if em_cache is None:
+        cache_logins.set(username, [utilizador[1], utilizador[2]])
+    return utilizador
+
+
+def atualiza_hash(id_utilizador, palavra_passe, hash_antigo):
+    # Substitui um hash antigo (SHA-256 ou com outro custo) depois de um login certo. Corre numa thread
+    # da pool de hashes, depois de o login ja ter respondido; so altera a linha se o hash nao tiver
+    # mudado entretanto, e uma falha fica no log e o hash antigo e substituido num proximo login
+    try:
+        novo = gera_hash(palavra_passe, PasswordHashing)
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute('UPDATE utilizador SET palavra_passe = %s WHERE id = %s AND palavra_passe = %s',
+                        (novo, id_utilizador, hash_antigo))
+            conn.commit()
+        finally:
+            db_release(conn)
+        hasher.conta_rehash()
+    except Exception as error:
+        logger.warning(f'POST /login - could not rehash password of user {id_utilizador}: {error}')
+
+
 @app.route('/login', methods=['POST'])
 def authentication():
     logger.info('POST /login ')
     payload = flask.request.get_json()
 
-    conn = db_connection()
-    cur = conn.cursor()
-
     logger.debug(f'POST /login - payload: {payload}')
 
     if ('username' not in payload) or ('password' not in payload):
@@ -897,102 +2525,95 @@ def authentication():
         return flask.jsonify(response)
 
     try:
-        cur.execute('BEGIN')
-        cur.execute('LOCK TABLE utilizador,artista,consumidor,administrador IN EXCLUSIVE MODE')
-
-        cur.execute('SELECT palavra_passe,id FROM utilizador WHERE username=%s', (payload['username'],))
-        result = cur.fetchone()
-        if result is not None:
-            hash_result = result[0]
-            id_user = result[1]
-            passe_hash = hashlib.sha256(payload['password'].encode('utf-8')).hexdigest()
-            if (passe_hash == hash_result):
-                cur.execute(
-                    "SELECT 'consumidor' AS tipo FROM consumidor, utilizador WHERE utilizador.username = %s AND utilizador.palavra_passe = %s AND consumidor.utilizador_id = utilizador.id "
-                    "UNION ALL "
-                    "SELECT 'artista' AS tipo FROM artista, utilizador WHERE utilizador.username = %s AND utilizador.palavra_passe = %s AND artista.utilizador_id = utilizador.id "
-                    "UNION ALL "
-                    "SELECT 'administrador' AS tipo FROM administrador, utilizador WHERE utilizador.username = %s AND utilizador.palavra_passe = %s AND administrador.utilizador_id = utilizador.id",
-                    (
-                        payload['username'], passe_hash, payload['username'], passe_hash, payload['username'],
-                        passe_hash))
-
-                tipo = cur.fetchone()[0]
-                payload['type'] = tipo
-                payload['id'] = id_user
-
-                '''statement = 'CREATE OR REPLACE FUNCTION atualizar_top_10() ' \
-                            'RETURNS TRIGGER AS $$ ' \
-                            'BEGIN ' \
-                            '-- Limpar as entradas anteriores na tabela musica_playlist\n ' \
-                            'DELETE FROM musica_playlist ' \
-                            'WHERE playlist_id = ( ' \
-                            'SELECT id ' \
-                            'FROM playlist ' \
-                            'WHERE nome = %s AND consumidor_utilizador_id = NEW.consumidor_utilizador_id ' \
-                            'LIMIT 1 ' \
-                            '); ' \
-                            '-- Selecionar as 10 músicas mais frequentes para o consumidor\n ' \
-                            'WITH top_10 AS ( ' \
-                            'SELECT ismn_musica, COUNT(*) AS total ' \
-                            'FROM contagem_musica ' \
-                            'WHERE consumidor_utilizador_id = NEW.consumidor_utilizador_id ' \
-                            'GROUP BY ismn_musica ' \
-                            'ORDER BY total DESC ' \
-                            'LIMIT 10 ' \
-                            ') ' \
-                            '-- Inserir as entradas na tabela musica_playlist \n' \
-                            'INSERT INTO musica_playlist (musica_id, playlist_id) ' \
-                            'SELECT c.ismn_musica, p.id ' \
-                            'FROM top_10 t ' \
-                            'CROSS JOIN playlist p ' \
-                            'WHERE p.nome = %s AND p.consumidor_utilizador_id = NEW.consumidor_utilizador_id; ' \
-                            'RETURN NULL; ' \
-                            'END; ' \
-                            '$$ LANGUAGE plpgsql;'
-                values = ("TOP10", "TOP10")
-                cur.execute(statement, values)
+        utilizador = le_utilizador(payload['username'])
+    except psycopg2.Error as error:
+        logger.error(f'POST /login - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response)
 
-                statement = 'CREATE TRIGGER atualizar_top_10_trigger ' \
-                            'AFTER INSERT ON contagem_musica ' \
-                            'FOR EACH ROW ' \
-                            'EXECUTE FUNCTION atualizar_top_10();'
-                cur.execute(statement)'''
+    if utilizador is None:
+        response = {'status': StatusCodes['api_error'], 'results': 'User does not exist'}
+        return flask.jsonify(response)
 
-                response = {'status': StatusCodes['success'], 'results': create_access_token(identity=payload)}
-                conn.commit()
-            else:
-                response = {'status': StatusCodes['api_error'], 'results': 'Login credentials not valid'}
-                conn.rollback()
-                return flask.jsonify(response)
-        else:
-            response = {'status': StatusCodes['api_error'], 'results': 'User does not exist'}
-            conn.rollback()
-            return flask.jsonify(response)
+    hash_result, id_user, tipo = utilizador
+    try:
+        certa, rehash = hasher.confirma(payload['password'], hash_result)
+    except queue.Full:
+        response = {'status': StatusCodes['service_unavailable'], 'errors': 'Too many logins in progress, try again later'}
+        return flask.jsonify(response)
 
-    except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'POST /login - error: {error}')
-        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        conn.rollback()
+    if not certa:
+        response = {'status': StatusCodes['api_error'], 'results': 'Login credentials not valid'}
+        return flask.jsonify(response)
 
-    finally:
-        if conn is not None:
-            conn.close()
+    if rehash:
+        hasher.em_fundo(atualiza_hash, id_user, payload['password'], hash_result)
+
+    response = {'status': StatusCodes['success'], 'results': cria_token(id_user, tipo)}
+    return flask.jsonify(response)
+
+
+@app.route('/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    logger.info('POST /logout')
+    token = get_jwt()
+    restante = token['exp'] - time.time() if 'exp' in token else duracao_token()
+    if not tokens_revogados.set(token['jti'], True, ttl=max(restante, 1)):
+        logger.error(f'POST /logout - revoked tokens list is full ({CacheConfig["revoked_max"]} entries)')
+        response = {'status': StatusCodes['service_unavailable'], 'errors': 'Could not revoke the token, try again later'}
+        return flask.jsonify(response)
+    response = {'status': StatusCodes['success'], 'results': 'Logged out'}
+    return flask.jsonify(response)
+
+
+@app.route('/revoke/<user_id>', methods=['POST'])
+@jwt_required()
+def revoke_user(user_id):
+    user_payload = utilizador_atual()
+    if (user_payload['type'] == "administrador"):
+        logger.info(f'POST /revoke/{user_id}')
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            response = {'status': StatusCodes['api_error'], 'results': 'Given user id is not valid'}
+            return flask.jsonify(response)
+
+        # O id e o tipo do utilizador em cache para o /login sao esquecidos antes da revogacao, para o
+        # proximo login ler o tipo atual da base de dados
+        conn = db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT username FROM utilizador WHERE id = %s', (user_id,))
+            utilizador = cur.fetchone()
+            conn.commit()
+        except psycopg2.Error as error:
+            logger.error(f'POST /revoke/{user_id} - error: {error}')
+            response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+            conn.rollback()
+            return flask.jsonify(response)
+        finally:
+            db_release(conn)
+        if utilizador is not None:
+            cache_logins.delete(utilizador[0])
 
+        if revoga_utilizador(user_id):
+            response = {'status': StatusCodes['success'], 'results': f'Tokens of user {user_id} revoked'}
+        else:
+            response = {'status': StatusCodes['service_unavailable'], 'errors': 'Could not revoke the tokens, try again later'}
+    else:
+        response = {'status': StatusCodes['api_error'], 'results': 'Only admins can revoke tokens'}
     return flask.jsonify(response)
 
 
 @app.route('/create', methods=['POST'])
 @jwt_required(optional=True)
 def add_user():
-    user_payload = get_jwt_identity()
+    user_payload = utilizador_atual()
     if user_payload is None:
         logger.info('POST /create ')
         payload = flask.request.get_json()
 
-        conn = db_connection()
-        cur = conn.cursor()
-
         logger.debug(f'POST /create - payload: {payload}')
 
         if ('username' not in payload) or ('password' not in payload) or ('nome' not in payload) or (
@@ -1004,12 +2625,20 @@ def add_user():
             response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
             return flask.jsonify(response)
 
+        try:
+            palavra_passe = hasher.gera(payload['password'])
+        except queue.Full:
+            response = {'status': StatusCodes['service_unavailable'], 'errors': 'Too many requests in progress, try again later'}
+            return flask.jsonify(response)
+
         statement = 'INSERT INTO utilizador (username,palavra_passe) VALUES (%s, %s) RETURNING id;'
-        values = (payload['username'], hashlib.sha256(payload['password'].encode('utf-8')).hexdigest())
+        values = (payload['username'], palavra_passe)
+
+        conn = db_connection()
+        cur = conn.cursor()
 
         try:
-            cur.execute('BEGIN')
-            cur.execute('LOCK TABLE utilizador,subscricao,consumidor,playlist IN EXCLUSIVE MODE')
+            inicia_transacao(cur, 'utilizador,subscricao,consumidor,playlist')
 
             cur.execute(statement, values)
             cur.execute("SELECT lastval()")
@@ -1037,6 +2666,14 @@ def add_user():
             response = {'status': StatusCodes['success'], 'results': f'Inserted user {id_utilizador}'}
 
 
+        except psycopg2.IntegrityError as error:
+            conn.rollback()
+            if error.diag.constraint_name == 'utilizador_username_idx':
+                response = {'status': StatusCodes['api_error'], 'results': 'Username already exists'}
+            else:
+                logger.error(f'POST /create - error: {error}')
+                response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(f'POST /create - error: {error}')
             response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
@@ -1046,7 +2683,7 @@ def add_user():
 
         finally:
             if conn is not None:
-                conn.close()
+                db_release(conn)
 
         return flask.jsonify(response)
 
@@ -1056,9 +2693,6 @@ def add_user():
             logger.info('POST /create ')
             payload = flask.request.get_json()
 
-            conn = db_connection()
-            cur = conn.cursor()
-
             logger.debug(f'POST /create - payload: {payload}')
 
             if ('username' not in payload) or ('password' not in payload) or ('nome' not in payload) or (
@@ -1071,12 +2705,20 @@ def add_user():
                 response = {'status': StatusCodes['api_error'], 'results': 'Fields cannot contain ";"'}
                 return flask.jsonify(response)
 
+            try:
+                palavra_passe = hasher.gera(payload['password'])
+            except queue.Full:
+                response = {'status': StatusCodes['service_unavailable'], 'errors': 'Too many requests in progress, try again later'}
+                return flask.jsonify(response)
+
             statement = 'INSERT INTO utilizador (username,palavra_passe) VALUES (%s, %s) RETURNING id;'
-            values = (payload['username'], hashlib.sha256(payload['password'].encode('utf-8')).hexdigest())
+            values = (payload['username'], palavra_passe)
+
+            conn = db_connection()
+            cur = conn.cursor()
 
             try:
-                cur.execute('BEGIN')
-                cur.execute('LOCK TABLE utilizador,artista IN EXCLUSIVE MODE')
+                inicia_transacao(cur, 'utilizador,artista')
 
                 cur.execute(statement, values)
                 cur.execute("SELECT lastval()")
@@ -1097,6 +2739,14 @@ def add_user():
                 response = {'status': StatusCodes['success'], 'results': f'Inserted artist {id_utilizador}'}
 
 
+            except psycopg2.IntegrityError as error:
+                conn.rollback()
+                if error.diag.constraint_name == 'utilizador_username_idx':
+                    response = {'status': StatusCodes['api_error'], 'results': 'Username already exists'}
+                else:
+                    logger.error(f'POST /create - error: {error}')
+                    response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
             except (Exception, psycopg2.DatabaseError) as error:
                 logger.error(f'POST /create - error: {error}')
                 response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
@@ -1106,7 +2756,7 @@ def add_user():
 
             finally:
                 if conn is not None:
-                    conn.close()
+                    db_release(conn)
 
             return flask.jsonify(response)
 
@@ -1115,6 +2765,624 @@ def add_user():
             return flask.jsonify(response)
 
 
+##########################################################
+## COMMANDS
+##########################################################
+
+def backfill_relatorio(argumentos):
+    # Reconstroi reproducoes_mes_genero a partir de todo o historico de contagem_musica
+    conn = db_connection()
+    cur = conn.cursor()
+    try:
+        # SHARE bloqueia novas reproducoes ate ao fim do backfill, para nenhuma ficar de fora ou ser contada duas vezes
+        cur.execute('LOCK TABLE contagem_musica IN SHARE MODE')
+        cur.execute('DELETE FROM reproducoes_mes_genero')
+        cur.execute('''
+            INSERT INTO reproducoes_mes_genero (mes, genero, particao, reproducoes)
+            SELECT date_trunc('month', cm.data)::DATE, COALESCE(m.genero, ''), cm.consumidor_utilizador_id % 8, COUNT(*)
+            FROM contagem_musica cm
+            INNER JOIN musica m ON m.ismn = cm.musica_ismn
+            GROUP BY 1, 2, 3
+        ''')
+        linhas = cur.rowcount
+        conn.commit()
+        logger.info(f'backfill_report - {linhas} rollup rows written')
+        return 0
+    except psycopg2.Error as error:
+        logger.error(f'backfill_report - error: {error}')
+        conn.rollback()
+        return 1
+    finally:
+        db_release(conn)
+
+
+def verifica_relatorio(argumentos):
+    # Compara o agregado com a contagem direta. Argumentos opcionais: um YYYY-MM verifica os 12 meses
+    # que /report/<YYYY-MM> devolve; dois YYYY-MM verificam os meses entre eles, inclusive
+    conn = db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        if len(argumentos) == 1:
+            inicio, fim = janela_relatorio(argumentos[0])
+        elif argumentos:
+            inicio = datetime.date(int(argumentos[0].split('-')[0]), int(argumentos[0].split('-')[1]), 1)
+            fim = datetime.date(int(argumentos[1].split('-')[0]), int(argumentos[1].split('-')[1]), 1)
+        else:
+            cur.execute("SELECT date_trunc('month', MIN(data))::DATE, date_trunc('month', MAX(data))::DATE FROM contagem_musica")
+            inicio, fim = cur.fetchone()
+            if inicio is None:
+                logger.info('check_report - no plays recorded')
+                return 0
+
+        agregado = {(linha[0], linha[1]): linha[2] for linha in consulta_relatorio(cur, inicio, fim)}
+        bruto = {(linha[0], linha[1]): linha[2] for linha in consulta_relatorio_bruto(cur, inicio, fim)}
+        conn.commit()
+    finally:
+        db_release(conn)
+
+    diferencas = 0
+    for chave in sorted(set(agregado) | set(bruto), key=str):
+        if agregado.get(chave, 0) != bruto.get(chave, 0):
+            diferencas += 1
+            logger.error(f'check_report - {chave[0]} {chave[1]}: rollup={agregado.get(chave, 0)} raw={bruto.get(chave, 0)}')
+
+    logger.info(f'check_report - {inicio} to {fim}: {len(bruto)} month/genre pairs checked, {diferencas} mismatches')
+    return 1 if diferencas else 0
+
+
+def le_catalogo(caminho):
+    # Devolve (numero da linha, dados, erro) para cada faixa de um ficheiro CSV ou JSONL
+    with open(caminho, 'r', encoding='utf-8', newline='') as arquivo:
+        if caminho.endswith('.csv'):
+            leitor = csv.DictReader(arquivo)
+            for dados in leitor:
+                yield leitor.line_num, dados, None
+        else:
+            for numero, linha in enumerate(arquivo, start=1):
+                if not linha.strip():
+                    continue
+                try:
+                    dados = json.loads(linha)
+                except ValueError as error:
+                    yield numero, linha.rstrip('\n'), f'invalid JSON: {error}'
+                    continue
+                if not isinstance(dados, dict):
+                    yield numero, dados, 'each line must be a JSON object'
+                    continue
+                yield numero, dados, None
+
+
+def referencia(valor):
+    # Um id (inteiro) ou um nome; devolve (id, nome) com um deles a None
+    valor = str(valor).strip()
+    if valor.isdigit() and len(valor) <= 9:
+        return int(valor), None
+    return None, valor
+
+
+def texto(dados, campo, obrigatorio=False):
+    valor = dados.get(campo)
+    if valor is None or str(valor).strip() == '':
+        if obrigatorio:
+            raise ValueError(f'missing {campo}')
+        return None
+    valor = str(valor).strip()
+    if len(valor) > 512:
+        raise ValueError(f'{campo} longer than 512 characters')
+    return valor
+
+
+def carrega_em_lotes(conn, comando, caminho, caminho_rejeitadas, tamanho, normaliza, grava, chave=None,
+                     ocultos=()):
+    # Le o ficheiro, valida cada linha com normaliza e grava lotes de ate tamanho linhas, cada um na sua
+    # transacao. grava(cur, [(linha, valor normalizado)]) devolve [(linha, motivo)] das rejeitadas; um
+    # erro da base de dados rejeita o lote inteiro e o carregamento continua. chave(valor) nao se pode
+    # repetir num lote, e os campos em ocultos nunca sao escritos no ficheiro das rejeitadas.
+    # Devolve (linhas aceites, linhas rejeitadas)
+    cur = conn.cursor()
+    inicio = time.monotonic()
+    lidas = 0
+    aceites = 0
+    rejeitadas = 0
+    originais = {}
+    lote = []
+    chaves = set()
+
+    def regista(arquivo, linha, motivo, dados):
+        if isinstance(dados, dict) and ocultos:
+            dados = {campo: valor for campo, valor in dados.items() if campo not in ocultos}
+        arquivo.write(json.dumps({'line': linha, 'reason': motivo, 'row': dados}, default=str) + '\n')
+
+    def grava_lote(arquivo):
+        try:
+            motivos = grava(cur, lote)
+            conn.commit()
+        except psycopg2.Error as error:
+            conn.rollback()
+            motivos = [(linha, f'batch failed: {error}') for linha, valor in lote]
+        for linha, motivo in motivos:
+            regista(arquivo, linha, motivo, originais.get(linha))
+        falhadas = len({linha for linha, motivo in motivos})
+        decorrido = time.monotonic() - inicio
+        logger.info(f'{comando} - {lidas} rows read, {aceites + len(lote) - falhadas} accepted, '
+                    f'{rejeitadas + falhadas} rejected, {lidas / decorrido:.0f} rows/s')
+        return len(lote) - falhadas, falhadas
+
+    with open(caminho_rejeitadas, 'w', encoding='utf-8') as arquivo:
+        for linha, dados, erro in le_catalogo(caminho):
+            lidas += 1
+            if erro is None:
+                try:
+                    valor = normaliza(dados)
+                except (TypeError, ValueError) as error:
+                    erro = str(error)
+            if erro is None and chave is not None and chave(valor) in chaves:
+                erro = f'{chave(valor)} repeated in the same batch'
+            if erro is not None:
+                regista(arquivo, linha, erro, dados)
+                rejeitadas += 1
+                continue
+
+            if chave is not None:
+                chaves.add(chave(valor))
+            originais[linha] = dados
+            lote.append((linha, valor))
+
+            if len(lote) >= tamanho:
+                novas, falhadas = grava_lote(arquivo)
+                aceites += novas
+                rejeitadas += falhadas
+                originais = {}
+                lote = []
+                chaves = set()
+
+        if lote:
+            novas, falhadas = grava_lote(arquivo)
+            aceites += novas
+            rejeitadas += falhadas
+
+    decorrido = time.monotonic() - inicio
+    logger.info(f'{comando} - done: {aceites} accepted, {rejeitadas} rejected (see {caminho_rejeitadas}), '
+                f'{lidas / decorrido if decorrido else 0:.0f} rows/s')
+    return aceites, rejeitadas
+
+
+def normaliza_faixa(dados):
+    titulo = texto(dados, 'title', obrigatorio=True)
+    genero = texto(dados, 'genre')
+    duracao = texto(dados, 'duration')
+    duracao = float(duracao) if duracao is not None else None
+    data = texto(dados, 'release_date', obrigatorio=True)
+    data = datetime.date.fromisoformat(data)
+    gravadora = referencia(texto(dados, 'publisher', obrigatorio=True))
+    album = texto(dados, 'album')
+    album_data = texto(dados, 'album_release_date')
+    album_data = datetime.date.fromisoformat(album_data) if album_data is not None else data
+
+    artistas = dados.get('artists')
+    if isinstance(artistas, str):
+        artistas = artistas.split('|')
+    artistas = [referencia(artista) for artista in (artistas or []) if str(artista).strip()]
+    if not artistas:
+        raise ValueError('missing artists')
+
+    return (titulo, genero, duracao, data, gravadora[0], gravadora[1], album, album_data), artistas
+
+
+def valor_copy(valor):
+    if valor is None:
+        return '\\N'
+    return str(valor).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copia_linhas(cur, tabela, colunas, linhas):
+    dados = io.StringIO()
+    for linha in linhas:
+        dados.write('\t'.join(valor_copy(valor) for valor in linha) + '\n')
+    dados.seek(0)
+    cur.copy_expert(f'COPY {tabela} ({", ".join(colunas)}) FROM STDIN', dados)
+
+
+def carrega_lote(cur, faixas, artistas):
+    # Junta um lote de faixas ja validadas ao catalogo; devolve [(linha, motivo)] das rejeitadas
+    copia_linhas(cur, 'staging_musica',
+                 ('linha', 'titulo', 'genero', 'duracao', 'data_de_lancamento', 'gravadora_ref', 'gravadora_nome',
+                  'album', 'album_data'),
+                 faixas)
+    copia_linhas(cur, 'staging_artista', ('linha', 'artista_ref', 'artista_nome'), artistas)
+
+    # Resolver as chaves estrangeiras para todo o lote de uma vez, por id ou por nome
+    cur.execute('''
+        UPDATE staging_musica AS s SET gravadora_id = g.id
+        FROM gravadora AS g WHERE g.id = s.gravadora_ref
+    ''')
+    cur.execute('''
+        UPDATE staging_musica AS s SET gravadora_id = g.id
+        FROM (SELECT DISTINCT ON (nome) nome, id FROM gravadora ORDER BY nome, id) AS g
+        WHERE s.gravadora_id IS NULL AND g.nome = s.gravadora_nome
+    ''')
+    cur.execute('''
+        UPDATE staging_artista AS s SET artista_id = a.utilizador_id
+        FROM artista AS a WHERE a.utilizador_id = s.artista_ref
+    ''')
+    cur.execute('''
+        UPDATE staging_artista AS s SET artista_id = a.utilizador_id
+        FROM (SELECT DISTINCT ON (nome_artistico) nome_artistico, utilizador_id FROM artista
+              ORDER BY nome_artistico, utilizador_id) AS a
+        WHERE s.artista_id IS NULL AND a.nome_artistico = s.artista_nome
+    ''')
+
+    cur.execute('''
+        SELECT linha, 'unknown publisher ' || COALESCE(gravadora_ref::TEXT, gravadora_nome)
+        FROM staging_musica WHERE gravadora_id IS NULL
+        UNION ALL
+        SELECT linha, 'unknown artist ' || COALESCE(artista_ref::TEXT, artista_nome)
+        FROM staging_artista WHERE artista_id IS NULL
+    ''')
+    rejeitadas = cur.fetchall()
+    if rejeitadas:
+        linhas = list({linha for linha, motivo in rejeitadas})
+        cur.execute('DELETE FROM staging_musica WHERE linha = ANY(%s)', (linhas,))
+        cur.execute('DELETE FROM staging_artista WHERE linha = ANY(%s)', (linhas,))
+
+    # Musicas novas, com os ismn da sequencia
+    cur.execute("UPDATE staging_musica SET ismn = nextval('ids_musica')")
+    cur.execute('''
+        INSERT INTO musica (ismn, titulo, genero, duracao, data_de_lancamento, gravadora_id)
+        SELECT ismn, titulo, genero, duracao, data_de_lancamento, gravadora_id FROM staging_musica
+    ''')
+    cur.execute('''
+        INSERT INTO artista_musica (artista_utilizador_id, musica_ismn)
+        SELECT DISTINCT a.artista_id, s.ismn
+        FROM staging_artista AS a INNER JOIN staging_musica AS s ON s.linha = a.linha
+    ''')
+
+    # Albuns: reutiliza um album com o mesmo titulo, editora e data (por exemplo de um lote anterior)
+    cur.execute('''
+        INSERT INTO album (titulo, data_de_lancamento, gravadora_id)
+        SELECT DISTINCT s.album, s.album_data, s.gravadora_id
+        FROM staging_musica AS s
+        WHERE s.album IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM album AS al
+            WHERE al.titulo = s.album AND al.gravadora_id = s.gravadora_id AND al.data_de_lancamento = s.album_data
+        )
+    ''')
+    cur.execute('''
+        UPDATE staging_musica AS s SET album_id = al.id
+        FROM (SELECT DISTINCT ON (titulo, gravadora_id, data_de_lancamento) titulo, gravadora_id, data_de_lancamento, id
+              FROM album ORDER BY titulo, gravadora_id, data_de_lancamento, id) AS al
+        WHERE s.album IS NOT NULL AND al.titulo = s.album AND al.gravadora_id = s.gravadora_id
+          AND al.data_de_lancamento = s.album_data
+    ''')
+    cur.execute('''
+        INSERT INTO musica_album (musica_ismn, album_id)
+        SELECT ismn, album_id FROM staging_musica WHERE album_id IS NOT NULL
+    ''')
+    cur.execute('''
+        INSERT INTO album_artista (album_id, artista_utilizador_id)
+        SELECT DISTINCT s.album_id, a.artista_id
+        FROM staging_musica AS s INNER JOIN staging_artista AS a ON a.linha = s.linha
+        WHERE s.album_id IS NOT NULL
+        ON CONFLICT (album_id, artista_utilizador_id) DO NOTHING
+    ''')
+    return rejeitadas
+
+
+def carrega_catalogo(argumentos):
+    # load_catalog <ficheiro .csv ou .jsonl> [ficheiro para as linhas rejeitadas]
+    if not argumentos:
+        logger.error('usage: load_catalog <catalog.csv|catalog.jsonl> [rejects.jsonl]')
+        return 2
+    caminho = argumentos[0]
+    caminho_rejeitadas = argumentos[1] if len(argumentos) > 1 else caminho + '.rejects.jsonl'
+
+    def grava(cur, lote):
+        faixas = []
+        artistas = []
+        for linha, (faixa, refs) in lote:
+            faixas.append((linha,) + faixa)
+            artistas += [(linha, ref[0], ref[1]) for ref in dict.fromkeys(refs)]
+        return carrega_lote(cur, faixas, artistas)
+
+    conn = db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS staging_musica (
+                linha		 BIGINT PRIMARY KEY,
+                titulo		 VARCHAR(512),
+                genero		 VARCHAR(512),
+                duracao		 FLOAT(8),
+                data_de_lancamento DATE,
+                gravadora_ref	 INTEGER,
+                gravadora_nome	 VARCHAR(512),
+                gravadora_id	 INTEGER,
+                album		 VARCHAR(512),
+                album_data	 DATE,
+                album_id	 INTEGER,
+                ismn		 INTEGER
+            ) ON COMMIT DELETE ROWS
+        ''')
+        cur.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS staging_artista (
+                linha	 BIGINT,
+                artista_ref	 INTEGER,
+                artista_nome VARCHAR(512),
+                artista_id	 INTEGER
+            ) ON COMMIT DELETE ROWS
+        ''')
+        conn.commit()
+
+        carrega_em_lotes(conn, 'load_catalog', caminho, caminho_rejeitadas, CatalogLoad['chunk'],
+                         normaliza_faixa, grava)
+    finally:
+        db_release(conn)
+    return 0
+
+
+def normaliza_utilizador(dados):
+    # Os mesmos campos obrigatorios e a mesma regra do ";" que o /create
+    campos = {'username': texto(dados, 'username', obrigatorio=True),
+              'password': dados.get('password'),
+              'nome': texto(dados, 'nome', obrigatorio=True),
+              'endereco': texto(dados, 'endereco', obrigatorio=True),
+              'data de nascimento': datetime.date.fromisoformat(texto(dados, 'data de nascimento', obrigatorio=True)),
+              'contacto': texto(dados, 'contacto', obrigatorio=True),
+              'nome artistico': texto(dados, 'nome artistico'),
+              'admin': texto(dados, 'admin')}
+    if not isinstance(campos['password'], str) or not campos['password']:
+        raise ValueError('missing password')
+    if any(isinstance(valor, str) and ';' in valor for valor in campos.values()):
+        raise ValueError('fields cannot contain ";"')
+    if campos['nome artistico'] is not None:
+        if campos['admin'] is None or not campos['admin'].isdigit():
+            raise ValueError('artists need the id of the admin that creates them in admin')
+        campos['admin'] = int(campos['admin'])
+    return campos
+
+
+def cria_utilizadores(cur, utilizadores):
+    # Cria um lote de contas ja validadas; devolve [(linha, motivo)] das rejeitadas
+    rejeitadas = []
+
+    administradores = list({u['admin'] for linha, u in utilizadores if u['nome artistico'] is not None})
+    cur.execute('SELECT utilizador_id FROM administrador WHERE utilizador_id = ANY(%s)', (administradores,))
+    existentes = {linha[0] for linha in cur.fetchall()}
+    validos = []
+    for linha, u in utilizadores:
+        if u['nome artistico'] is not None and u['admin'] not in existentes:
+            rejeitadas.append((linha, f'unknown admin {u["admin"]}'))
+        else:
+            validos.append((linha, u))
+
+    # Os ids sao reservados antes, para saber a que linha pertence cada id devolvido pelo INSERT
+    cur.execute("SELECT nextval('ids_utilizador') FROM generate_series(1, %s)", (len(validos),))
+    ids = [linha[0] for linha in cur.fetchall()]
+    novos = psycopg2.extras.execute_values(cur, '''
+        INSERT INTO utilizador (id, username, palavra_passe) VALUES %s
+        ON CONFLICT (username) DO NOTHING
+        RETURNING id
+    ''', [(id_utilizador, u['username'], u['hash']) for id_utilizador, (linha, u) in zip(ids, validos)],
+        page_size=len(validos) or 1, fetch=True)
+    novos = {linha[0] for linha in novos}
+
+    consumidores = []
+    artistas = []
+    for id_utilizador, (linha, u) in zip(ids, validos):
+        if id_utilizador not in novos:
+            rejeitadas.append((linha, 'username already exists'))
+        elif u['nome artistico'] is None:
+            consumidores.append((u['nome'], u['endereco'], u['data de nascimento'], u['contacto'], id_utilizador))
+        else:
+            artistas.append((u['nome'], u['nome artistico'], u['endereco'], u['data de nascimento'], u['contacto'],
+                             u['admin'], id_utilizador))
+
+    if consumidores:
+        psycopg2.extras.execute_values(cur, '''
+            INSERT INTO consumidor (nome, endereco, data_de_nascimento, informacoes_de_contacto, utilizador_id)
+            VALUES %s
+        ''', consumidores, page_size=len(consumidores))
+        # Plano Regular e playlist TOP10 de todos os consumidores do lote, como no /create
+        ids_consumidores = [consumidor[4] for consumidor in consumidores]
+        cur.execute('''
+            INSERT INTO subscricao (tipo_de_plano, data_de_inicio, data_de_validade, consumidor_utilizador_id)
+            SELECT 'Regular', NULL, NULL, id FROM unnest(%s::INTEGER[]) AS id
+        ''', (ids_consumidores,))
+        cur.execute('''
+            INSERT INTO playlist (nome, visibilidade, consumidor_utilizador_id)
+            SELECT 'TOP10', false, id FROM unnest(%s::INTEGER[]) AS id
+        ''', (ids_consumidores,))
+
+    if artistas:
+        psycopg2.extras.execute_values(cur, '''
+            INSERT INTO artista (nome, nome_artistico, endereco, data_de_nascimento, informacoes_de_contacto,
+                                 administrador_utilizador_id, utilizador_id)
+            VALUES %s
+        ''', artistas, page_size=len(artistas))
+
+    return rejeitadas
+
+
+def cria_contas(argumentos):
+    # provision_users <ficheiro .jsonl ou .csv> [ficheiro para as linhas rejeitadas]
+    # Campos iguais aos do /create; as linhas com "nome artistico" criam artistas e precisam de "admin"
+    if not argumentos:
+        logger.error('usage: provision_users <users.jsonl|users.csv> [rejects.jsonl]')
+        return 2
+    caminho = argumentos[0]
+    caminho_rejeitadas = argumentos[1] if len(argumentos) > 1 else caminho + '.rejects.jsonl'
+
+    def grava(cur, lote):
+        # Os hashes de todo o lote sao calculados em paralelo antes de abrir a transacao
+        hashes = hasher.gera_varios([u['password'] for linha, u in lote])
+        for (linha, u), palavra_passe in zip(lote, hashes):
+            u['hash'] = palavra_passe
+        return cria_utilizadores(cur, lote)
+
+    conn = db_connection()
+    try:
+        # A palavra-passe nunca e escrita no ficheiro das rejeitadas
+        carrega_em_lotes(conn, 'provision_users', caminho, caminho_rejeitadas, UserProvisioning['chunk'],
+                         normaliza_utilizador, grava, chave=lambda u: u['username'], ocultos=('password',))
+    finally:
+        db_release(conn)
+    return 0
+
+
+# Ligacoes a base de dados herdadas do processo pai: nunca sao usadas nem fechadas no filho, porque
+# fechar uma ligacao envia o fim da sessao pelo socket que o pai continua a usar
+ligacoes_herdadas = []
+
+
+def reinicia_estado():
+    # Num processo criado por fork as threads do pai nao existem e os locks podem ter ficado adquiridos:
+    # a pool, a fila de reproducoes, as caches e a pool de hashes sao criadas de novo
+    global pool, ingestor, cache_artistas, cache_planos, cache_comentarios, cache_logins, hasher
+    global tokens_revogados, utilizadores_revogados, metricas
+    ligacoes_herdadas.extend(conn for conn, devolvida in pool._livres)
+    pool = ConnectionPool(PoolConfig['min'], PoolConfig['max'], PoolConfig['wait_timeout'],
+                          PoolConfig['max_idle'], PoolConfig['check_after'])
+    ingestor = PlayIngestor(PlayIngestion['queue_size'], PlayIngestion['batch_size'], PlayIngestion['flush_interval'])
+    cache_artistas = cria_cache('artist_info', CacheConfig['artist_max'], CacheConfig['artist_ttl'])
+    cache_planos = cria_cache('plan', CacheConfig['plan_max'], CacheConfig['plan_max_ttl'])
+    cache_comentarios = cria_cache('comments', CacheConfig['comment_max'], CacheConfig['comment_ttl'])
+    cache_logins = cria_cache('login', CacheConfig['login_max'], CacheConfig['login_ttl'])
+    hasher = PasswordHasher(PasswordHashing['workers'], PasswordHashing['queue_size'], PasswordHashing['wait_timeout'])
+    tokens_revogados = cria_lista_revogacoes('revoked_tokens')
+    utilizadores_revogados = cria_lista_revogacoes('revoked_users')
+    metricas = Metricas(MetricsConfig['samples'])
+
+
+os.register_at_fork(after_in_child=reinicia_estado)
+
+
+def serve_prefork(host, port, workers):
+    # O pai so abre o socket e mantem workers filhos vivos; cada filho corre um servidor com threads
+    servidor_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    servidor_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    servidor_socket.bind((host, port))
+    servidor_socket.listen(1024)
+
+    # DB_POOL_MAX e o total de ligacoes de todos os workers, para nao passar o max_connections do PostgreSQL
+    ligacoes_por_worker = max(1, PoolConfig['max'] // workers)
+    if PoolConfig['max'] < workers:
+        logger.warning(f'DB_POOL_MAX={PoolConfig["max"]} is lower than the {workers} workers: '
+                       f'each worker still gets 1 connection ({workers} in total)')
+
+    def arranca_worker():
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        # Filho: SIGTERM e SIGINT terminam o servidor e a fila de reproducoes e gravada antes de sair
+        signal.signal(signal.SIGTERM, lambda *argumentos: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        codigo = 0
+        try:
+            pool.maxconn = ligacoes_por_worker
+            pool.minconn = min(pool.minconn, ligacoes_por_worker)
+            pool.preenche()
+            make_server(host, port, app, threaded=True, fd=servidor_socket.fileno()).serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception as error:
+            logger.error(f'worker {os.getpid()} - error: {error}')
+            codigo = 1
+        ingestor.termina()
+        logging.shutdown()
+        os._exit(codigo)
+
+    filhos = {}  # pid -> instante em que o worker foi criado
+    for i in range(workers):
+        filhos[arranca_worker()] = time.monotonic()
+    logger.info(f'API v1.0 online ({workers} workers, up to {ligacoes_por_worker} database connections each): '
+                f'http://{host}:{port}')
+
+    a_terminar = False
+
+    def termina(*argumentos):
+        nonlocal a_terminar
+        a_terminar = True
+        for pid in filhos:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, termina)
+    signal.signal(signal.SIGINT, termina)
+
+    codigo = 0
+    falhas_seguidas = 0
+    while filhos:
+        try:
+            pid, estado = os.wait()
+        except ChildProcessError:
+            break
+        criado = filhos.pop(pid, None)
+        if a_terminar:
+            continue
+
+        # Um worker que morre e substituido, para o servidor manter sempre workers processos; se morrem
+        # logo ao arrancar (por exemplo sem acesso a base de dados) a espera cresce ate o servidor desistir
+        if criado is not None and time.monotonic() - criado < ServerConfig['worker_min_uptime']:
+            falhas_seguidas += 1
+        else:
+            falhas_seguidas = 0
+        if falhas_seguidas >= ServerConfig['worker_max_failures']:
+            logger.error(f'{falhas_seguidas} workers in a row exited within {ServerConfig["worker_min_uptime"]}s '
+                         f'of starting, giving up')
+            codigo = 1
+            termina()
+            continue
+
+        espera = min(2 ** falhas_seguidas - 1, 30)
+        logger.warning(f'worker {pid} exited with status {estado}, starting a new one in {espera}s')
+        time.sleep(espera)
+        if not a_terminar:
+            filhos[arranca_worker()] = time.monotonic()
+    servidor_socket.close()
+    return codigo
+
+
+def serve(argumentos):
+    # serve [dev|asgi|prefork [workers]]; sem argumento usa SERVER_MODE
+    modo = argumentos[0] if argumentos else ServerConfig['mode']
+    host = ServerConfig['host']
+    port = ServerConfig['port']
+
+    if modo == 'prefork':
+        workers = int(argumentos[1]) if len(argumentos) > 1 else ServerConfig['workers']
+        return serve_prefork(host, port, workers)
+
+    if modo == 'asgi':
+        if uvicorn is None:
+            logger.error('serve asgi requires the uvicorn and a2wsgi packages')
+            return 2
+        pool.preenche()
+        logger.info(f'API v1.0 online (asgi, {ServerConfig["asgi_threads"]} threads): http://{host}:{port}')
+        uvicorn.run(WSGIMiddleware(app, workers=ServerConfig['asgi_threads']), host=host, port=port,
+                    timeout_keep_alive=ServerConfig['keep_alive'], log_level='warning')
+        return 0
+
+    if modo != 'dev':
+        logger.error(f'Unknown server mode {modo}, available: dev, asgi, prefork')
+        return 2
+    pool.preenche()
+    logger.info(f'API v1.0 online: http://{host}:{port}')
+    app.run(host=host, debug=True, threaded=True, port=port)
+    return 0
+
+
+Comandos = {
+    'serve': serve,
+    'backfill_report': backfill_relatorio,
+    'check_report': verifica_relatorio,
+    'load_catalog': carrega_catalogo,
+    'provision_users': cria_contas
+}
+
+
 if __name__ == '__main__':
     # set up logging
     logging.basicConfig(filename='log_file.log')
@@ -1128,8 +3396,11 @@ if __name__ == '__main__':
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
-    host = '127.0.0.1'
-    port = 8080
-    app.run(host=host, debug=True, threaded=True, port=port)
-    logger.info(f'API v1.0 online: http://{host}:{port}')
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in Comandos:
+            logger.error(f'Unknown command {sys.argv[1]}, available: {", ".join(Comandos)}')
+            sys.exit(2)
+        sys.exit(Comandos[sys.argv[1]](sys.argv[2:]))
+
+    sys.exit(serve([]))
     # print("I'm here")
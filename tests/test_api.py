@@ -0,0 +1,136 @@
+import importlib.util
+import logging
+import os
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_jwt_extended')
+pytest.importorskip('psycopg2')
+
+CAMINHO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'projeto (1).py')
+
+
+@pytest.fixture(scope='module')
+def api():
+    # Carrega a API sem a arrancar; nenhum destes testes chega a abrir uma ligacao a base de dados
+    spec = importlib.util.spec_from_file_location('projeto', CAMINHO)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    modulo.logger = logging.getLogger('tests')
+    return modulo
+
+
+def cabecalho(api, id_utilizador, tipo):
+    with api.app.app_context():
+        return {'Authorization': 'Bearer ' + api.cria_token(id_utilizador, tipo)}
+
+
+class CursorFalso:
+    def execute(self, *argumentos):
+        pass
+
+
+class LigacaoFalsa:
+    def cursor(self):
+        return CursorFalso()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@pytest.mark.parametrize('valor', [None, 0, -3, [1], {'n': 1}, 'dez'])
+def test_card_rejeita_number_cards_invalido(api, valor):
+    resposta = api.app.test_client().post('/card', json={'number_cards': valor, 'card_price': '10'},
+                                          headers=cabecalho(api, 1, 'administrador'))
+
+    assert resposta.status_code == 200
+    assert resposta.get_json() == {'status': 400, 'results': 'Number of cards must be a positive integer'}
+
+
+def test_card_aceita_number_cards_inteiro(api, monkeypatch):
+    monkeypatch.setattr(api, 'db_connection', lambda: LigacaoFalsa())
+    monkeypatch.setattr(api, 'db_release', lambda conn: None)
+    monkeypatch.setattr(api, 'insere_cartoes', lambda cur, numero, preco, validade, admin: list(range(numero)))
+
+    resposta = api.app.test_client().post('/card', json={'number_cards': 5, 'card_price': '10'},
+                                          headers=cabecalho(api, 1, 'administrador'))
+
+    assert resposta.get_json() == {'status': 200, 'results': [0, 1, 2, 3, 4]}
+
+
+@pytest.mark.parametrize('valor, tem', [('a;b', 1), (['a', ['b;']], 1), ({'x': 'c;'}, 1), (['a', 'b'], 0),
+                                        (None, 0), (5, 0), (True, 0), ([1, 2], 0)])
+def test_ponto_virgula_recursivo(api, valor, tem):
+    assert api.ponto_virgula_recursivo(valor) == tem
+
+
+def test_lista_revogacoes_recusa_quando_cheia_sem_esquecer_entradas(api):
+    lista = api.ListaRevogacoes('teste', 2)
+
+    assert lista.set('a', True, ttl=60)
+    assert lista.set('b', True, ttl=60)
+    assert not lista.set('c', True, ttl=60)
+    assert lista.get('a') and lista.get('b') and lista.get('c') is None
+    # Revogar de novo uma chave que ja esta na lista nao ocupa mais espaco
+    assert lista.set('a', True, ttl=60)
+    assert lista.stats()['rejected'] == 1
+
+
+def test_lista_revogacoes_liberta_espaco_quando_expiram(api):
+    lista = api.ListaRevogacoes('teste', 1)
+
+    assert lista.set('a', True, ttl=0)
+    assert lista.get('a') is None
+    assert lista.set('b', True, ttl=60)
+    assert lista.stats()['entries'] == 1
+
+
+def test_revogacao_recusa_tokens_anteriores_e_aceita_os_seguintes(api, monkeypatch):
+    from flask_jwt_extended import decode_token
+
+    monkeypatch.setattr(api, 'utilizadores_revogados', api.ListaRevogacoes('revoked_users', 10))
+    with api.app.app_context():
+        antigo = decode_token(api.cria_token(7, 'consumidor'))
+        assert api.revoga_utilizador(7)
+        revogado_em = api.utilizadores_revogados.get('7')
+        # Um token emitido no mesmo segundo da revogacao, mas antes dela, tambem e recusado
+        assert api.token_revogado({}, dict(antigo, iat=revogado_em))
+        assert api.token_revogado({}, antigo)
+
+        novo = decode_token(api.cria_token(7, 'consumidor'))
+        assert novo['iat'] > revogado_em
+        assert not api.token_revogado({}, novo)
+
+
+@pytest.mark.parametrize('playlist_id', ['abc', '1;2', '1.5'])
+def test_append_playlist_rejeita_id_invalido(api, playlist_id):
+    resposta = api.app.test_client().post(f'/playlist/{playlist_id}/songs', json={'songs': [1]},
+                                          headers=cabecalho(api, 3, 'consumidor'))
+
+    assert resposta.get_json() == {'status': 400, 'results': 'Given playlist id is not valid'}
+
+
+def test_revoke_esquece_o_utilizador_em_cache_para_o_login(api, monkeypatch):
+    class CursorUsername(CursorFalso):
+        def fetchone(self):
+            return ('edu',)
+
+    class LigacaoUsername(LigacaoFalsa):
+        def cursor(self):
+            return CursorUsername()
+
+    monkeypatch.setattr(api, 'db_connection', lambda: LigacaoUsername())
+    monkeypatch.setattr(api, 'db_release', lambda conn: None)
+    monkeypatch.setattr(api, 'cache_logins', api.LocalCache('login', 10, 60))
+    monkeypatch.setattr(api, 'utilizadores_revogados', api.ListaRevogacoes('revoked_users', 10))
+    api.cache_logins.set('edu', [5, 'consumidor'])
+
+    resposta = api.app.test_client().post('/revoke/5', headers=cabecalho(api, 1, 'administrador'))
+
+    assert resposta.get_json()['status'] == 200
+    assert api.cache_logins.get('edu') is None
+    assert api.utilizadores_revogados.get('5') is not None
@@ -0,0 +1,66 @@
+import hashlib
+
+import pytest
+
+from palavras_passe import calcula_hash, confirma_hash, gera_hash, novos_parametros
+
+# Custos pequenos para os testes correrem depressa
+SCRYPT = {'algorithm': 'scrypt', 'scrypt_n': 2 ** 4, 'scrypt_r': 8, 'scrypt_p': 1, 'pbkdf2_iterations': 1000}
+PBKDF2 = dict(SCRYPT, algorithm='pbkdf2_sha256')
+
+
+@pytest.mark.parametrize('configuracao', [SCRYPT, PBKDF2])
+def test_formato_e_confirmacao(configuracao):
+    guardado = gera_hash('segredo', configuracao)
+    partes = guardado.split('$')
+
+    assert partes[0] == configuracao['algorithm']
+    assert len(partes) == (6 if configuracao is SCRYPT else 4)
+    assert len(partes[-2]) == 32 and len(partes[-1]) == 64
+    assert calcula_hash('segredo', partes[:-1]) == guardado
+    assert confirma_hash('segredo', guardado, configuracao) == (True, False)
+
+
+def test_salt_diferente_em_cada_hash():
+    assert gera_hash('segredo', SCRYPT) != gera_hash('segredo', SCRYPT)
+
+
+@pytest.mark.parametrize('configuracao', [SCRYPT, PBKDF2])
+def test_palavra_passe_errada(configuracao):
+    certa, _ = confirma_hash('outra', gera_hash('segredo', configuracao), configuracao)
+    assert not certa
+
+
+def test_sha256_antigo_aceite_e_recalculado():
+    antigo = hashlib.sha256(b'segredo').hexdigest()
+
+    assert confirma_hash('segredo', antigo, SCRYPT) == (True, True)
+    assert confirma_hash('outra', antigo, SCRYPT) == (False, True)
+
+
+@pytest.mark.parametrize('alteracao', [{'scrypt_n': 2 ** 5}, {'scrypt_r': 4}, {'scrypt_p': 2},
+                                       {'algorithm': 'pbkdf2_sha256'}])
+def test_recalcula_quando_muda_o_custo_do_scrypt(alteracao):
+    guardado = gera_hash('segredo', SCRYPT)
+    assert confirma_hash('segredo', guardado, dict(SCRYPT, **alteracao)) == (True, True)
+
+
+@pytest.mark.parametrize('alteracao', [{'pbkdf2_iterations': 2000}, {'algorithm': 'scrypt'}])
+def test_recalcula_quando_muda_o_custo_do_pbkdf2(alteracao):
+    guardado = gera_hash('segredo', PBKDF2)
+    assert confirma_hash('segredo', guardado, dict(PBKDF2, **alteracao)) == (True, True)
+
+
+def test_custo_do_outro_algoritmo_nao_obriga_a_recalcular():
+    guardado = gera_hash('segredo', SCRYPT)
+    assert confirma_hash('segredo', guardado, dict(SCRYPT, pbkdf2_iterations=2000)) == (True, False)
+
+
+@pytest.mark.parametrize('guardado', ['bcrypt$12$abc$def', 'scrypt$16$8', 'pbkdf2_sha256$x$00$00'])
+def test_hash_em_formato_desconhecido_nao_aceite(guardado):
+    assert confirma_hash('segredo', guardado, SCRYPT) == (False, False)
+
+
+def test_novos_parametros_seguem_a_configuracao():
+    assert novos_parametros(SCRYPT)[:-1] == ['scrypt', '16', '8', '1']
+    assert novos_parametros(PBKDF2)[:-1] == ['pbkdf2_sha256', '1000']